@@ -1,11 +1,16 @@
 import os
 import csv
 import logging
-import time
-import json
+import orjson
+import asyncio
 from typing import List, Dict, Set, Optional
 from datetime import datetime
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiolimiter import AsyncLimiter
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
 from ftplib import FTP_TLS
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
@@ -22,44 +27,73 @@ FTP_USER = os.getenv('FTP_USER')
 FTP_PASS = os.getenv('FTP_PASS')
 ISBNDB_API_KEY = os.getenv('ISBNDB_API_KEY')
 
+ISBNDB_URL = "https://api2.isbndb.com/books"
+
 BATCH_SIZE = 100
+MAX_CONCURRENT_REQUESTS = 16
+ISBNDB_RPS = float(os.getenv('ISBNDB_RPS', 3))
 MAX_API_RETRIES = 3
 API_RETRY_DELAY = 2
+FTP_BLOCK_SIZE = 256 * 1024
+FTP_MAX_WORKERS = 8
+NULL_VALUES = (None, "", "null")
+
+
+def _ftp_connect() -> FTP_TLS:
+    """Open a logged-in FTP session in the inventory folder"""
+    ftp = FTP_TLS(FTP_URL)
+    ftp.login(FTP_USER, FTP_PASS)
+    ftp.cwd('/inventory')
+    return ftp
 
+def _download_one(filename: str) -> Optional[str]:
+    """Download a single file over its own FTP session"""
+    local_path = f"downloaded/{filename}"
+    try:
+        with _ftp_connect() as ftp:
+            with open(local_path, 'wb', buffering=1 << 20) as f:
+                ftp.retrbinary(f'RETR {filename}', f.write, blocksize=FTP_BLOCK_SIZE)
+        return local_path
+    except Exception as e:
+        logging.error(f"FTP Error downloading {filename}: {str(e)}")
+        return None
 
 def download_ftp_files() -> List[str]:
     """Download all txt files from FTP inventory folder"""
-    downloaded_files = []
     try:
-        with FTP_TLS(FTP_URL) as ftp:
-            ftp.login(FTP_USER, FTP_PASS)
-            ftp.cwd('/inventory')
-            
+        with _ftp_connect() as ftp:
             files = [f for f in ftp.nlst() if f.upper().endswith('.TXT')]
-            if not files:
-                tqdm.write("No TXT files found in FTP directory")
-                return []
-
-            with tqdm(files, desc="Downloading files", unit="file") as pbar:
-                for filename in pbar:
-                    local_path = f"downloaded/{filename}"
-                    os.makedirs('downloaded', exist_ok=True)
-                    
-                    with open(local_path, 'wb') as f:
-                        ftp.retrbinary(f'RETR {filename}', f.write)
-                    downloaded_files.append(local_path)
-                    pbar.set_postfix(file=filename[:15])
     except Exception as e:
         logging.error(f"FTP Error: {str(e)}")
-    return downloaded_files
+        return []
+
+    if not files:
+        tqdm.write("No TXT files found in FTP directory")
+        return []
+
+    os.makedirs('downloaded', exist_ok=True)
+    # Each worker holds its own session, so files download in parallel
+    with ThreadPoolExecutor(max_workers=FTP_MAX_WORKERS) as executor:
+        results = list(tqdm(executor.map(_download_one, files), total=len(files),
+                            desc="Downloading files", unit="file"))
+    return [path for path in results if path]
+
+# Proactive limiter keeps us under the ISBNdb plan quota instead of waiting out 429s
+ISBNDB_LIMITER = AsyncLimiter(ISBNDB_RPS, 1)
+_isbndb_resume_at = 0.0
+
+def _pause_isbndb(seconds: float) -> None:
+    """Hold back every pending ISBNdb request for the given number of seconds"""
+    global _isbndb_resume_at
+    _isbndb_resume_at = max(_isbndb_resume_at, asyncio.get_running_loop().time() + seconds)
 
 def normalize_column_name(name: str) -> str:
     """Convert column name to lowercase and sanitize"""
     return name.strip().lower()
 
-def process_files(file_paths: List[str]) -> tuple[List[Dict], Set[str], Set[str]]:
+def process_files(file_paths: List[str]) -> tuple[List[pa.Table], Set[str], Set[str]]:
     """Process CSV files, filter valid rows, and collect all columns"""
-    all_rows = []
+    tables = []
     ean_set = set()
     all_input_columns = set()
     
@@ -67,55 +101,60 @@ def process_files(file_paths: List[str]) -> tuple[List[Dict], Set[str], Set[str]
     with tqdm(file_paths, desc="Processing files", unit="file") as pbar:
         for file_path in pbar:
             try:
-                with open(file_path, 'r') as f:
-                    reader = csv.reader(f)
-                    next(reader)  # Skip HEADER row
-                    headers = [normalize_column_name(h) for h in next(reader)]
-                    all_input_columns.update(headers)
-                    
-                    try:
-                        stock_idx = headers.index('stock')
-                    except ValueError:
-                        logging.error(f"'stock' column missing in {file_path}")
-                        continue
+                with open(file_path, 'r', newline='') as f:
+                    f.readline()  # Skip HEADER row
+                    headers = [normalize_column_name(h) for h in next(csv.reader([f.readline()]))]
+                all_input_columns.update(headers)
 
-                    row_count = 0
-                    for row in tqdm(reader, desc=f"Processing {os.path.basename(file_path)}", leave=False):
-                        
-                        if len(row) <= stock_idx or int(row[stock_idx].strip()) <= 4:
-                            continue
-                        
-                        row_dict = {headers[i]: val.strip() for i, val in enumerate(row)}
-                        all_rows.append(row_dict)
-                        ean_set.add(row_dict['ean'])
-                        row_count += 1
-                    
-                    pbar.set_postfix(rows=row_count, file=os.path.basename(file_path))
+                if 'stock' not in headers:
+                    logging.error(f"'stock' column missing in {file_path}")
+                    continue
+
+                # Parse the whole file natively; every column stays a string so EANs keep leading zeros
+                table = pacsv.read_csv(
+                    file_path,
+                    read_options=pacsv.ReadOptions(skip_rows=2, column_names=headers),
+                    parse_options=pacsv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+                    convert_options=pacsv.ConvertOptions(column_types={h: pa.string() for h in headers})
+                )
+                table = pa.Table.from_arrays(
+                    [pc.utf8_trim_whitespace(col) for col in table.columns], names=headers
+                )
+                table = table.filter(pc.greater(pc.cast(table['stock'], pa.int32()), 4))
+
+                tables.append(table)
+                ean_set.update(table['ean'].to_pylist())
+                pbar.set_postfix(rows=table.num_rows, file=os.path.basename(file_path))
             except Exception as e:
                 logging.error(f"Error processing {file_path}: {str(e)}")
 
-    tqdm.write(f"Processed {len(all_rows)} valid records from {len(file_paths)} files")
-    return all_rows, ean_set, all_input_columns
+    tqdm.write(f"Processed {sum(t.num_rows for t in tables)} valid records from {len(file_paths)} files")
+    return tables, ean_set, all_input_columns
 
 @retry(stop=stop_after_attempt(MAX_API_RETRIES), 
        wait=wait_exponential(multiplier=1, min=API_RETRY_DELAY, max=30))
-def fetch_bulk_book_details(identifiers: List[str], id_type: str) -> Dict[str, Optional[Dict]]:
+async def fetch_bulk_book_details(session: aiohttp.ClientSession, identifiers: List[str],
+                                  id_type: str) -> Dict[str, Optional[Dict]]:
     """Bulk fetch book details with proper JSON handling"""
     if not identifiers:
         return {}
 
-    url = "https://api2.isbndb.com/books"
-    headers = {
-        "Authorization": ISBNDB_API_KEY,
-        "Content-Type": "application/json"
-    }
-    
     try:
         payload = 'isbns=' + ','.join(identifiers)
-        response = requests.post(url, headers=headers, data=payload, timeout=30)
-        response.raise_for_status()
-        
-        json_response = response.json()
+        await asyncio.sleep(max(0.0, _isbndb_resume_at - asyncio.get_running_loop().time()))
+        async with ISBNDB_LIMITER, session.post(ISBNDB_URL, data=payload) as response:
+            if response.headers.get('X-RateLimit-Remaining') == '0':
+                _pause_isbndb(1)
+            if response.status == 429:
+                retry_after = int(response.headers.get('Retry-After', 30))
+                tqdm.write(f"Rate limited. Waiting {retry_after}s...")
+                _pause_isbndb(retry_after)
+            elif response.status >= 400:
+                logging.error(f"HTTP Error {response.status}: {await response.text()}")
+                return {}
+            response.raise_for_status()
+
+            json_response = orjson.loads(await response.read())
         books = json_response.get("data", [])
         
         return {
@@ -124,14 +163,9 @@ def fetch_bulk_book_details(identifiers: List[str], id_type: str) -> Dict[str, O
             if book.get(id_type)
         }
         
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            retry_after = int(e.response.headers.get('Retry-After', 30))
-            tqdm.write(f"Rate limited. Waiting {retry_after}s...")
-            time.sleep(retry_after)
-            raise
-        logging.error(f"HTTP Error {e.response.status_code}: {e.response.text}")
-        return {}
+    except aiohttp.ClientResponseError:
+        # Only rate limiting gets here; let tenacity back off and retry
+        raise
     except Exception as e:
         logging.error(f"API Request failed: {str(e)}")
         return {}
@@ -152,34 +186,41 @@ def process_book_data(book: Dict) -> Dict:
         "binding": book.get("binding")
     }
 
+async def _fetch_all_batches(batches: List[List[str]]) -> List[Dict[str, Optional[Dict]]]:
+    """Run batch requests concurrently over one pooled session"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    headers = {
+        "Authorization": ISBNDB_API_KEY,
+        "Content-Type": "application/json"
+    }
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        with tqdm(total=sum(len(b) for b in batches), desc="Fetching book data", unit="EAN") as pbar:
+
+            async def fetch_batch(batch_num: int, batch: List[str]) -> Dict[str, Optional[Dict]]:
+                async with semaphore:
+                    try:
+                        result = await fetch_bulk_book_details(session, batch, "isbn13")
+                    except Exception as e:
+                        logging.error(f"Batch {batch_num} failed: {str(e)}")
+                        result = {}
+                pbar.update(len(batch))
+                return result
+
+            return await asyncio.gather(*(fetch_batch(i, b) for i, b in enumerate(batches)))
+
 def fetch_book_data(eans: List[str]) -> Dict[str, Dict]:
     """Orchestrate batch API requests with fail-safes"""
+    batches = [eans[i:i + BATCH_SIZE] for i in range(0, len(eans), BATCH_SIZE)]
+
     api_data = {}
-    total_eans = len(eans)
-    
-    with tqdm(total=total_eans, desc="Fetching book data", unit="EAN") as pbar:
-        batch_num = 0
-        while batch_num * BATCH_SIZE < total_eans:
-            try:
-                start_idx = batch_num * BATCH_SIZE
-                end_idx = start_idx + BATCH_SIZE
-                batch = eans[start_idx:end_idx]
-                
-                result = fetch_bulk_book_details(batch, "isbn13")
-                api_data.update(result)
-                
-                pbar.update(len(batch))
-                batch_num += 1
-                
-                # time.sleep(0.5)
-                
-            except Exception as e:
-                logging.error(f"Batch {batch_num} failed: {str(e)}")
-                if batch_num * BATCH_SIZE >= total_eans:
-                    break
-                continue
+    for result in asyncio.run(_fetch_all_batches(batches)):
+        api_data.update(result)
     
-    tqdm.write(f"API processing completed. Matched {len(api_data)}/{total_eans} EANs")
+    tqdm.write(f"API processing completed. Matched {len(api_data)}/{len(eans)} EANs")
     return api_data
 
 def main():
@@ -196,55 +237,60 @@ def main():
         unmatched_csv = f"output/unmatched_{timestamp}.csv"
 
         # Process files and collect all columns
-        all_rows, all_eans, all_input_columns = process_files(files)
+        tables, all_eans, all_input_columns = process_files(files)
         api_data = fetch_book_data(list(all_eans))
 
         # Define API fields
         api_fields = {'title', 'description', 'cover_image', 'author', 'publisher', 
                       'publication_year', 'language', 'isbn10', 'isbn13', 'pages', 'binding'}
-        matched_fieldnames = sorted(all_input_columns | api_fields)
-        unmatched_fieldnames = sorted(all_input_columns)
-
-        # Collect data in memory
-        matched_data = []
-        unmatched_data = []
-
-        with tqdm(total=len(all_rows), desc="Processing records") as pbar:
-            for row in all_rows:
-                try:
-                    ean = row['ean'].strip()
-                    if ean in api_data:
-                        book_data = api_data[ean]
-                        merged = {k.lower(): v for k, v in {**row, **book_data}.items() 
-                                if v not in (None, "", "null")}
-                        matched_data.append(merged)
-                    else:
-                        clean_row = {k.lower(): v for k, v in row.items()}
-                        unmatched_data.append(clean_row)
-                    pbar.update(1)
-                except Exception as e:
-                    logging.error(f"Error processing record: {str(e)}")
-                    continue
+        matched_fieldnames = tuple(sorted(all_input_columns | api_fields))
+        unmatched_fieldnames = tuple(sorted(all_input_columns))
+
+        matched_count = 0
+        unmatched_count = 0
 
-        # Write matched CSV with consistent columns
-        if matched_data:
-            with open(matched_csv, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=matched_fieldnames, restval='')
-                writer.writeheader()
-                writer.writerows(matched_data)
+        # Stream rows straight to both CSVs in a fixed column order
+        with open(matched_csv, 'w', newline='', encoding='utf-8') as matched_file, \
+                open(unmatched_csv, 'w', newline='', encoding='utf-8') as unmatched_file, \
+                tqdm(total=sum(t.num_rows for t in tables), desc="Processing records") as pbar:
+            matched_writer = csv.writer(matched_file)
+            matched_writer.writerow(matched_fieldnames)
+            unmatched_writer = csv.writer(unmatched_file)
+            unmatched_writer.writerow(unmatched_fieldnames)
 
-        # Write unmatched CSV with consistent columns
-        if unmatched_data:
-            with open(unmatched_csv, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=unmatched_fieldnames, restval='')
-                writer.writeheader()
-                writer.writerows(unmatched_data)
+            for table in tables:
+                # Walk the columns side by side; a row dict is only built for output
+                columns = table.to_pydict()
+                names = list(columns)
+                # Unmatched rows are written positionally: output column -> index in this
+                # table, or None where the table lacks that column
+                position = {name: i for i, name in enumerate(names)}
+                unmatched_index = [position.get(c) for c in unmatched_fieldnames]
+                for ean, values in zip(columns['ean'], zip(*columns.values())):
+                    try:
+                        book_data = api_data.get(ean)
+                        if book_data is not None:
+                            # Keys are already lower-case on both sides; nulls are blanked on write
+                            merged = dict(zip(names, values)) | book_data
+                            matched_writer.writerow(['' if (v := merged.get(c)) in NULL_VALUES else v
+                                                     for c in matched_fieldnames])
+                            matched_count += 1
+                        else:
+                            # Column names are lower-cased once in process_files
+                            unmatched_writer.writerow(['' if i is None else values[i]
+                                                       for i in unmatched_index])
+                            unmatched_count += 1
+                        pbar.update(1)
+                    except Exception as e:
+                        logging.error(f"Error processing record: {str(e)}")
+                        continue
 
         tqdm.write(f"\nProcessing completed")
-        tqdm.write(f"Matched records: {len(matched_data)} ({os.path.abspath(matched_csv)})")
-        tqdm.write(f"Unmatched records: {len(unmatched_data)} ({os.path.abspath(unmatched_csv)})")
+        tqdm.write(f"Matched records: {matched_count} ({os.path.abspath(matched_csv)})")
+        tqdm.write(f"Unmatched records: {unmatched_count} ({os.path.abspath(unmatched_csv)})")
         
-        upload_csv_to_supabase(matched_csv)
+        if matched_count:
+            upload_csv_to_supabase(matched_csv)
 
     except Exception as e:
         logging.error(f"Critical error: {str(e)}")
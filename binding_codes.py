@@ -0,0 +1,79 @@
+import re
+from types import MappingProxyType
+
+# Binding Type Short Codes, shared by every listing script (read-only)
+BINDING_SHORTCODES = MappingProxyType({
+    # Exact match mappings
+    'Album': 'ALB',
+    'Audio Cassette': 'ACS',
+    'Audio CD': 'ACD',
+    'Bath Book': 'BTH',
+    'Blu-ray': 'BRY',
+    'Board book': 'BBK',
+    'board_book': 'BBK',  # Alternate format
+    'Bonded Leather': 'BLE',
+    'Calendar': 'CAL',
+    'Card Book': 'CRB',
+    'Cards': 'CRD',
+    'CD-ROM': 'CDR',
+    'Diary': 'DIR',
+    'DVD': 'DVD',
+    'DVD Audio': 'DVA',
+    'DVD-ROM': 'DVR',
+    'Flexibound': 'FB',
+    'Game': 'GAM',
+    'Hardcover': 'HC',
+    'Hardcover-spiral': 'HCS',
+    'Imitation Leather': 'IML',
+    'JP Oversized': 'JPO',
+    'Kindle Edition': 'KIN',
+    'Kindle Edition with Audio/Video': 'KAV',
+    'Kitchen': 'KIT',
+    'Leather Bound': 'LB',
+    'Library Binding': 'LIB',
+    'Loose Leaf': 'LSL',
+    'Map': 'MAP',
+    'Mass Market Paperback': 'MMP',
+    'mass_market': 'MMP',  # Alternate format
+    'Misc.': 'MSC',
+    'Misc. Supplies': 'MSC',
+    'Notebook': 'NTB',
+    'Novelty Book': 'NOV',
+    'Office Product': 'OFP',
+    'Pamphlet': 'PAM',
+    'Paperback': 'PB',
+    'Paperback Bunko': 'PBU',
+    'Perfect Paperback': 'PPB',
+    'Pocket Book': 'PKB',
+    'Poster': 'POS',
+    'print': 'PRT',
+    'Print on Demand (Paperback)': 'POD',
+    'Printed Access Code': 'PAC',
+    'Product Bundle': 'PRB',
+    'Rag Book': 'RGB',
+    'Ring-bound': 'RNG',
+    'School & Library Binding': 'SLB',
+    'Sheet music': 'STM',
+    'Spiral-bound': 'SPI',
+    'Sports': 'SPT',
+    'Staple Bound': 'STB',
+    'Stationery': 'STN',
+    'Textbook Binding': 'TXB',
+    'Toy': 'TOY',
+    'Unbound': 'UBD',
+    'Unknown Binding': 'UNK',
+    'VHS Tape': 'VHS',
+    'Wall Chart': 'WCH'
+})
+# Case-insensitive fallback, e.g. 'paperback' or 'HARDCOVER'
+BINDING_SHORTCODES_CI = MappingProxyType({k.lower(): v for k, v in BINDING_SHORTCODES.items()})
+
+# Title shortening falls back to these for the two commonest bindings; the
+# main table wins where both define a code
+BINDING_WITH_DEFAULTS = MappingProxyType({'Paperback': 'Pb', 'Hardcover': 'Hc', **BINDING_SHORTCODES})
+
+# Whole-word matchers for each known binding, compiled once for the scripts that
+# still shorten titles with re.sub
+BINDING_PATTERNS = MappingProxyType({
+    binding: re.compile(r'\b' + re.escape(binding) + r'\b') for binding in BINDING_WITH_DEFAULTS
+})
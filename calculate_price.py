@@ -1,28 +1,101 @@
+import functools
+
+PER_ITEM = 0.08
+QUANTITY = 1
+EBAY_FPF = 9.9
+DROPSHIP_FEE = 0.7
+PRO_MARGIN = 10
+EBAY_FIXED_FEE = 0.3
+VAT_RATES = {'z': 0.0, 's': 20.0}  # any other code is the 5% reduced rate
+# Net-to-gross multipliers, worked out once rather than from the percentage per item
+VAT_MULTIPLIERS = {code: 1 + rate / 100 for code, rate in VAT_RATES.items()}
+REDUCED_VAT_MULTIPLIER = 1.05
+
+
 def inclusive_price(item):
-    
+
     rrp = float(item.get('rrp', 0))
     discount = float(item.get('discount', 0))
     weight = float(item.get('weight', 0))
-    per_item = 0.08
-    quantity = 1
-    ebay_fpf = 9.9
-    dropship_fee = 0.7
-    pro_margin = 10
-    ebay_fixed_fee = 0.3
 
+    return inclusive_price_from_fields(rrp, discount, weight)
+
+
+def inclusive_price_from_fields(rrp, discount, weight):
+    """inclusive_price for values that are already floats"""
     cp = rrp - (rrp * (discount / 100))
 
     if weight > 1600:
         pfee = 2.57
     else:
         pfee = 2.22
-        
-    item_fee = per_item * quantity
 
-    base_cost = cp + item_fee + pfee + dropship_fee
+    item_fee = PER_ITEM * QUANTITY
 
-    ebay_fee = (base_cost * (ebay_fpf / 100)) + item_fee
+    base_cost = cp + item_fee + pfee + DROPSHIP_FEE
+
+    ebay_fee = (base_cost * (EBAY_FPF / 100)) + item_fee
+
+    final_price = ((base_cost + ebay_fee) * (1 + PRO_MARGIN / 100)) + EBAY_FIXED_FEE
 
-    final_price = ((base_cost + ebay_fee) * (1 + pro_margin / 100)) + ebay_fixed_fee
-    
     return final_price
+
+
+@functools.lru_cache(maxsize=8192)
+def cached_start_price(rrp, discount, weight, vat_code):
+    """
+    VAT-inclusive start price rounded to pence. Keyed on the raw column values, so
+    the many items sharing an (rrp, discount, weight, vat_code) are priced once
+    """
+    multiplier = VAT_MULTIPLIERS.get(vat_code.lower(), REDUCED_VAT_MULTIPLIER)
+    net_price = inclusive_price_from_fields(float(rrp), float(discount), float(weight)) * multiplier
+    return round(net_price, 2)
+
+
+# Postgres regex for the text values float() accepts in practice; anything else is not cast
+_NUMERIC_TEXT_RE = r"^\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?\s*$"
+
+
+def _numeric_sql(column):
+    """
+    column::numeric, or NULL when the value is blank or not a number. The regex is
+    matched against column::text so this works whether the column is TEXT or numeric
+    """
+    return f"(CASE WHEN {column}::text ~ '{_NUMERIC_TEXT_RE}' THEN {column}::numeric END)"
+
+
+def start_price_sql():
+    """
+    cached_start_price as a Postgres expression over the rrp, discount, weight and
+    vat_code columns, built from the constants above so the two cannot drift apart.
+    A row with a non-numeric rrp, discount or weight gets NULL rather than failing
+    the whole statement. Postgres rounds numeric halves away from zero where Python
+    rounds the binary float, so at the pence boundary the two can differ by 0.01;
+    treat this as a pre-filter and keep the Python price as the authority
+    """
+    rrp, discount, weight = (_numeric_sql(column) for column in ('rrp', 'discount', 'weight'))
+    cp = f"({rrp} - {rrp} * {discount} / 100)"
+    pfee = f"(CASE WHEN {weight} > 1600 THEN 2.57 ELSE 2.22 END)"
+    item_fee = f"{PER_ITEM * QUANTITY}"
+    base_cost = f"({cp} + {item_fee} + {pfee} + {DROPSHIP_FEE})"
+    ebay_fee = f"({base_cost} * {EBAY_FPF / 100} + {item_fee})"
+    final_price = f"(({base_cost} + {ebay_fee}) * {1 + PRO_MARGIN / 100} + {EBAY_FIXED_FEE})"
+    vat_cases = ' '.join(f"WHEN '{code}' THEN {multiplier}" for code, multiplier in VAT_MULTIPLIERS.items())
+    vat_multiplier = f"(CASE lower(vat_code) {vat_cases} ELSE {REDUCED_VAT_MULTIPLIER} END)"
+    return f"round({final_price} * {vat_multiplier}, 2)"
+
+
+def inclusive_prices(rrp, discount, weight):
+    """Vectorized inclusive_price over NumPy arrays of rrp, discount and weight"""
+    # Imported here so the scripts that only price per item do not need NumPy installed
+    import numpy as np
+
+    cp = rrp - (rrp * (discount / 100))
+    pfee = np.where(weight > 1600, 2.57, 2.22)
+    item_fee = PER_ITEM * QUANTITY
+
+    base_cost = cp + item_fee + pfee + DROPSHIP_FEE
+
+    ebay_fee = (base_cost * (EBAY_FPF / 100)) + item_fee
+
+    return ((base_cost + ebay_fee) * (1 + PRO_MARGIN / 100)) + EBAY_FIXED_FEE
@@ -1,20 +1,31 @@
 import requests
+import orjson
+import numpy as np
 import urllib.parse
 import base64
 import re
-import time
+import threading
+from string import Template
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from supabase import create_client, Client
 from ebaysdk.trading import Connection
 from ebaysdk.exception import ConnectionError
 from ebaysdk.utils import dict2xml
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_SHORTCODES, BINDING_SHORTCODES_CI
+from calculate_price import VAT_RATES, inclusive_prices
+from rate_limiter import TokenBucket
 
 
 # Configuration
 table_name = os.getenv('SUPABASE_TABLE_NAME')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+INVENTORY_PAGE_SIZE = 1000
+DAILY_LISTING_LIMIT = 1495
+EBAY_MAX_WORKERS = 8
+EBAY_CALLS_PER_SECOND = 4
 EBAY_CREDENTIALS = {
     'client_id': os.getenv('EBAY_CLIENT_ID'),
     'client_secret': os.getenv('EBAY_CLIENT_SECRET'),
@@ -28,172 +39,221 @@ EBAY_CREDENTIALS = {
     }
 }
 
-# Binding Type Short Codes
-BINDING_SHORTCODES = {
-    # Exact match mappings
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',  # Alternate format
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',  # Alternate format
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}
+_YEAR_RE = re.compile(r'\b\d{4}\b')
+
+# AddFixedPriceItem body; only the $-fields change per item, so it is filled in
+# with string substitution instead of walking a payload dict through dict2xml
+_ADD_ITEM_TEMPLATE = Template(
+    "<Item>"
+    "<Title>$title</Title>"
+    "<Description>$description</Description>"
+    "<PrimaryCategory><CategoryID>29290</CategoryID></PrimaryCategory>"
+    "<ConditionID>1000</ConditionID>"
+    "<Currency>GBP</Currency>"
+    "<ListingType>FixedPriceItem</ListingType>"
+    "<StartPrice>$start_price</StartPrice>"
+    "<Quantity>$quantity</Quantity>"
+    "<Country>GB</Country>"
+    "<Location>Port Glasgow</Location>"
+    "<ListingDuration>GTC</ListingDuration>"
+    "<BusinessPolicies><PaymentPolicyID>$payment_policy</PaymentPolicyID></BusinessPolicies>"
+    "<ReturnPolicy>"
+    "<ReturnsAcceptedOption>ReturnsAccepted</ReturnsAcceptedOption>"
+    "<RefundOption>MoneyBack</RefundOption>"
+    "<ReturnsWithinOption>Days_30</ReturnsWithinOption>"
+    "<ShippingCostPaidByOption>Buyer</ShippingCostPaidByOption>"
+    "</ReturnPolicy>"
+    "<ShippingDetails><ShippingServiceOptions>"
+    "<ShippingServicePriority>1</ShippingServicePriority>"
+    "<ShippingService>UK_RoyalMailSecondClassStandard</ShippingService>"
+    "<ShippingServiceCost>3.00</ShippingServiceCost>"
+    "<FreeShipping>false</FreeShipping>"
+    "<ShippingServiceAdditionalCost>0.00</ShippingServiceAdditionalCost>"  # Added to fix shipping warning
+    "</ShippingServiceOptions></ShippingDetails>"
+    "<DispatchTimeMax>1</DispatchTimeMax>"
+    "<ProductListingDetails><ISBN>$isbn</ISBN></ProductListingDetails>"
+    "<ItemSpecifics>"
+    "<NameValueList><Name>Title</Name><Value>$title</Value></NameValueList>"
+    "<NameValueList><Name>Author</Name><Value>$author</Value></NameValueList>"
+    "<NameValueList><Name>Binding</Name><Value>$binding</Value></NameValueList>"
+    "<NameValueList><Name>Language</Name><Value>$language</Value></NameValueList>"
+    "<NameValueList><Name>ISBN</Name><Value>$isbn</Value></NameValueList>"
+    "<NameValueList><Name>Publisher</Name><Value>$publisher</Value></NameValueList>"
+    "$publication_year"
+    "</ItemSpecifics>"
+    "$picture_details"
+    "</Item>"
+    "<WarningLevel>High</WarningLevel>"
+    "<ErrorLanguage>en_US</ErrorLanguage>"
+)
+
+def build_add_item_xml(item, title, author_last, isbn, publisher, binding, language, pub_year, start_price):
+    """Render the AddFixedPriceItem request body for one item, escaping every per-item value"""
+    return _ADD_ITEM_TEMPLATE.substitute(
+        title=escape(title),
+        description=escape(str(item.get('description', 'No description available'))),
+        start_price=f"{start_price:.2f}",
+        quantity=escape(str(item['stock'])),
+        payment_policy=escape(str(EBAY_CREDENTIALS['business_policies']['payment'])),
+        isbn=escape(str(isbn)),
+        author=escape(author_last),
+        binding=escape(str(binding)),
+        language=escape(str(language)),
+        publisher=escape(str(publisher)),
+        publication_year=(
+            f"<NameValueList><Name>Publication Year</Name><Value>{pub_year}</Value></NameValueList>"
+            if pub_year else ""
+        ),
+        picture_details=(
+            f"<PictureDetails><PictureURL>{escape(item['cover_image'])}</PictureURL></PictureDetails>"
+            if item.get('cover_image') else ""
+        ),
+    )
+
+# Shared across worker threads; replaces the old fixed one-second sleep per listing
+EBAY_RATE_LIMITER = TokenBucket(EBAY_CALLS_PER_SECOND)
+_thread_state = threading.local()
 
 
 
 def generate_book_title(book_name, author, binding_type=None, publication_year=None, binding_codes=None):
-    binding_codes = binding_codes or {}
+    binding_codes = binding_codes or BINDING_SHORTCODES
     ellipsis = "…"
     
     # Helper to truncate text with ellipsis at end
     def truncate(text, max_len):
         return text[:max_len-1] + ellipsis if len(text) > max_len else text
 
+    # Variation 1: Full format with binding/year - fits for most items, so try it first
+    title = f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip()
+    if len(title) <= 65:
+        return title
+
     # Determine binding abbreviation if present
     binding_abbr = None
     if binding_type:
-        if binding_type == 'Paperback':
-            binding_abbr = 'PB'
-        elif binding_type == 'Hardcover':
-            binding_abbr = 'HC'
-        else:
-            binding_abbr = binding_codes.get(binding_type, binding_type)
-
-    # Build components dynamically
-    components = {
-        'book': book_name,
-        'by': "by",
-        'author': author,
-        'binding': binding_abbr,
-        'year': publication_year
-    }
+        binding_abbr = (binding_codes.get(binding_type)
+                        or BINDING_SHORTCODES_CI.get(binding_type.lower(), binding_type))
+
+    # Tail shared by every shortened variation, built once
+    suffix = f" {binding_abbr or ''} Book {publication_year or ''}"
 
-    # Generate title variations in priority order
-    variations = []
-    
-    # Variation 1: Full format with binding/year
-    variations.append(f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip())
-    
     # Variation 2: Abbreviated binding
-    variations.append(f"{book_name} by {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
+    title = f"{book_name} by {author}{suffix}".strip()
+    if len(title) <= 65:
+        return title
     
     # Variation 3: Remove "by"
-    variations.append(f"{book_name} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
+    title = f"{book_name} {author}{suffix}".strip()
+    if len(title) <= 65:
+        return title
     
     # Variation 4: Truncate author
-    base_length = len(f"{book_name} ") + len(f" {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
-    max_author_len = 65 - base_length - 1  # -1 for ellipsis
+    max_author_len = 65 - (len(book_name) + len(suffix.strip()) + 2) - 1  # -1 for ellipsis
     if max_author_len >= 1:
-        truncated_author = truncate(author, max_author_len)
-        variations.append(f"{book_name} {truncated_author} {binding_abbr or ''} Book {publication_year or ''}".strip())
+        title = f"{book_name} {truncate(author, max_author_len)}{suffix}".strip()
+        if len(title) <= 65:
+            return title
     
     # Variation 5: Truncate book name
-    base_length = len(f" {author} {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
-    max_book_len = 65 - base_length - 1  # -1 for ellipsis
+    max_book_len = 65 - (len(f" {author}{suffix}".strip()) + 1) - 1  # -1 for ellipsis
     if max_book_len >= 1:
-        truncated_book = truncate(book_name, max_book_len)
-        variations.append(f"{truncated_book} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
-    # Find first valid variation
-    for title in variations:
+        title = f"{truncate(book_name, max_book_len)} {author}{suffix}".strip()
         if len(title) <= 65:
-            return title[:65]  # Ensure exact length
+            return title
     
     # Final fallback: Book title only with ellipsis
     return truncate(book_name, 62).ljust(65, ellipsis)[:65]
 
 def extract_year(date_str):
     """Extract year from various date formats"""
-    match = re.search(r'\b\d{4}\b', str(date_str))
+    text = date_str if isinstance(date_str, str) else str(date_str)
+    # Fast path for the usual 'YYYY' / 'YYYY-MM-DD' values: a leading four-digit word
+    if len(text) >= 4 and text[:4].isdecimal() and not (text[4:5].isalnum() or text[4:5] == '_'):
+        return text[:4]
+    match = _YEAR_RE.search(text)
     return match.group(0) if match else None
 
 
-def calculate_start_price(item , final_price):
+def _as_float(value):
+    """float() that turns missing or malformed pricing data into NaN"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def calculate_start_prices(items):
+    """
+    Calculate listing prices for a whole page based on RRP, discount, weight and VAT
+    Returns rounded prices, with None where the pricing data is invalid
     """
-    Calculate listing price based on RRP, discount, and VAT
-    Returns rounded price or None if invalid data
+    rrp = np.array([_as_float(item.get('rrp', 0)) for item in items])
+    discount = np.array([_as_float(item.get('discount', 0)) for item in items])
+    weight = np.array([_as_float(item.get('weight', 0)) for item in items])
+    vat_percent = np.array([
+        VAT_RATES.get(vat_code.lower(), 5.0) if isinstance(vat_code, str) else np.nan
+        for vat_code in (item.get('vat_code') for item in items)
+    ])
+
+    net_prices = inclusive_prices(rrp, discount, weight) * (1 + (vat_percent / 100))
+    # Rounded with round() like cached_start_price, not np.round, which scales by 100 and
+    # rounds half to even, so batch and per-item prices can differ by a penny
+    return [None if np.isnan(price) else round(float(price), 2) for price in net_prices]
+
+def get_connection(access_token):
+    """ebaysdk connections are not thread-safe, so each worker thread gets its own"""
+    connection = getattr(_thread_state, 'connection', None)
+    if connection is None:
+        connection = _thread_state.connection = Connection(
+            debug=False,
+            domain='api.ebay.com',
+            config_file=None,
+            certid=EBAY_CREDENTIALS['client_secret'],
+            appid=EBAY_CREDENTIALS['client_id'],
+            devid=EBAY_CREDENTIALS['dev_id'],
+            token=access_token,
+            siteid=3
+        )
+    return connection
+
+def submit_listing(payload, access_token):
+    """Runs on a worker thread: wait for a rate-limit token, then call AddFixedPriceItem
+
+    `payload` is the pre-rendered request body; ebaysdk passes strings through as-is
     """
+    EBAY_RATE_LIMITER.acquire()
+    return get_connection(access_token).execute('AddFixedPriceItem', payload)
+
+def report_listing(future, item_id, title):
+    """Print the outcome of a submitted listing; returns 1 if eBay accepted the call"""
     try:
-                
-        vat_percent = (item['vat_code']).lower()
-        
-        if vat_percent == 'z':
-            vat_percent = float(0.0)
-        elif vat_percent == 's':
-            vat_percent = float(20.0)
-        else:
-            vat_percent = float(5.0)
-
-        # Validate input values
-        if any(val < 0 for val in [vat_percent]):
-            print(f"Invalid negative value in pricing data for item {item.get('id')}")
-            return None
-
-        net_price = final_price * (1 + (vat_percent / 100))
-        
-        # Return price rounded to 2 decimal places
-        return round(net_price, 2)
-    
-    except KeyError as e:
-        print(f"Missing required pricing field {e} for item {item.get('id')}")
-        return None
-    except (TypeError, ValueError) as e:
-        print(f"Invalid pricing data for item {item.get('id')}: {str(e)}")
-        return None
+        response = future.result()
+    except Exception as e:
+        print(f"Failed to process item {item_id}: {str(e)}")
+        return 0
+
+    reply = response.dict()
+    if reply['Ack'] == 'Warning':
+        print(f"Successfully listed: {title} (ID: {reply['ItemID']})")
+    else:
+        print(f"Error listing {title}: {reply.get('Errors', 'Unknown error')}")
+    return 1
+
+def iter_inventory(supabase, page_size=INVENTORY_PAGE_SIZE):
+    """Stream inventory rows page by page so listing starts after the first page"""
+    start = 0
+    while True:
+        rows = (supabase.table(table_name).select('*')
+                .order('publication_year', desc=True).order('id')
+                .range(start, start + page_size - 1)
+                .execute().data)
+        # Price the page in one vectorized pass rather than per item
+        for item, start_price in zip(rows, calculate_start_prices(rows)):
+            item['start_price'] = start_price
+        yield from rows
+        if len(rows) < page_size:
+            return
+        start += page_size
 
 def main():
     # Initialize Supabase
@@ -220,26 +280,23 @@ def main():
             "redirect_uri": EBAY_CREDENTIALS['redirect_uri']
         }
     )
-    access_token = token_response.json()['access_token']
-
-    # Initialize eBay API connection
-    connection = Connection(
-        debug=False,
-        domain='api.ebay.com',
-        config_file=None,
-        certid=EBAY_CREDENTIALS['client_secret'],
-        appid=EBAY_CREDENTIALS['client_id'],
-        devid=EBAY_CREDENTIALS['dev_id'],
-        token=access_token,
-        siteid=3
-    )
+    access_token = orjson.loads(token_response.content)['access_token']
+
     success_count = 0
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=EBAY_MAX_WORKERS)
     # Process inventory
-    inventory = supabase.table(table_name).select('*').order('publication_year', desc=True).execute().data
-    for item in inventory:
+    for item in iter_inventory(supabase):
         
-        if success_count >= 1495:
-            print("1495 items listed, stopping for the day.")
+        # Keep a bounded number of listings in flight and never overshoot the daily cap
+        while pending and (len(pending) >= EBAY_MAX_WORKERS * 2
+                           or success_count + len(pending) >= DAILY_LISTING_LIMIT):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                success_count += report_listing(future, *pending.pop(future))
+
+        if success_count >= DAILY_LISTING_LIMIT:
+            print(f"{DAILY_LISTING_LIMIT} items listed, stopping for the day.")
             break
         
         try:
@@ -248,107 +305,44 @@ def main():
                 language = 'English'
             
 
-            # Format components
+            # Format components (each field is read once per item)
+            author = item['author']
+            author_last = author.rsplit(None, 1)[-1]
+            isbn = item['isbn13']
+            publisher = item.get('publisher', 'Unknown')
             binding = item.get('binding', 'unknown')
             pub_year = extract_year(item.get('publication_year'))
             title = generate_book_title(
                 item['title'],
-                item['author'], binding,
+                author, binding,
                 pub_year, BINDING_SHORTCODES
                 
             )
 
-            # Build listing payload
-            payload = {
-                "Item": {
-                    "Title": title,
-                    "Description": item.get('description', 'No description available'),
-                    "PrimaryCategory": {"CategoryID": "29290"},  
-                    "ConditionID": "1000",  
-                    "Currency": "GBP",
-                    "ListingType": "FixedPriceItem",
-                    "StartPrice": '45',
-                    "Quantity": str(item['stock']),
-                    "Country": "GB",
-                    "Location": "Port Glasgow",
-                    "ListingDuration": "GTC",
-                    "BusinessPolicies": {
-                        
-                        "PaymentPolicyID": EBAY_CREDENTIALS['business_policies']['payment']
-                        
-                    },
-                    "ReturnPolicy": {
-                    "ReturnsAcceptedOption": "ReturnsAccepted",
-                    "RefundOption": "MoneyBack",
-                    "ReturnsWithinOption": "Days_30",
-                    "ShippingCostPaidByOption": "Buyer"
-                    },
-                    "ShippingDetails": {
-                    "ShippingServiceOptions": {
-                        "ShippingServicePriority": "1",
-                        "ShippingService": "UK_RoyalMailSecondClassStandard",
-                        "ShippingServiceCost": "3.00",
-                        "FreeShipping": "false",
-                        "ShippingServiceAdditionalCost": "0.00"  # Added to fix shipping warning
-                    }
-                },
-                    "DispatchTimeMax": "1",
-                    "ProductListingDetails": {
-                        "ISBN": item['isbn13']
-                        
-                    },
-                    "ItemSpecifics": {
-                        "NameValueList": [
-                            {"Name": "Title", "Value": [title]},
-                            {"Name": "Author", "Value": [item['author'].split()[-1]]},
-                            {"Name": "Binding", "Value": [binding]},
-                            {"Name": "Language", "Value": [language]},
-                            {"Name": "ISBN", "Value": [item.get('isbn13', 'Unknown')]},
-                            {"Name": "Publisher", "Value": [item.get('publisher', 'Unknown')]}
-                        ]
-                    }
-                },
-                "WarningLevel": "High",
-                "ErrorLanguage": "en_US",
-                  
-            }
-
-            # Add publication year if available
-            if pub_year:
-                payload["Item"]["ItemSpecifics"]["NameValueList"].append(
-                    {"Name": "Publication Year", "Value": [pub_year]}
-                )
-
-            # Add image if available
-            if item.get('cover_image'):
-                payload["Item"]["PictureDetails"] = {"PictureURL": [item['cover_image']]}
-                
-            calculated_price_vat_exclusive = inclusive_price(item)
-            
-            calculated_price  = calculate_start_price(item, calculated_price_vat_exclusive) 
+            calculated_price = item['start_price']
             
             print(calculated_price)
             if not calculated_price or calculated_price < 0.99:
                 print(f"Skipping item {item.get('id')} - invalid price calculation")
                 continue
-            payload["Item"]["StartPrice"] = f"{calculated_price:.2f}" 
-            
 
+            # Build listing payload
+            payload = build_add_item_xml(
+                item, title, author_last, isbn, publisher,
+                binding, language, pub_year, calculated_price
+            )
 
             # Submit listing
-            response = connection.execute('AddFixedPriceItem', payload)
-            success_count += 1
-            
-            if response.dict()['Ack'] == 'Warning':
-                print(f"Successfully listed: {title} (ID: {response.dict()['ItemID']})")
-            else:
-                print(f"Error listing {title}: {response.dict().get('Errors', 'Unknown error')}")
-            
-            time.sleep(1)  # Rate limit
+            future = executor.submit(submit_listing, payload, access_token)
+            pending[future] = (item.get('id'), title)
 
         except Exception as e:
             print(f"Failed to process item {item.get('id')}: {str(e)}")
             continue
 
+    for future in as_completed(pending):
+        success_count += report_listing(future, *pending[future])
+    executor.shutdown()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,18 +1,34 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
 import base64
-import re
+import functools
+import io
+import json
+import threading
 import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from supabase import create_client, Client
-import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import Element, SubElement, tostring
+from lxml import etree
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_SHORTCODES
+from listing_common import LISTING_COLUMNS, calculate_start_price, listings_from_rows, xml_escape, xml_safe
+from prefetch import prefetch
+from rate_limiter import TokenBucket
 
 # Configuration
 table_name = os.getenv('SUPABASE_TABLE_NAME')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+INVENTORY_PAGE_SIZE = 1000
+EBAY_TOKEN_URL = "https://api.ebay.com/identity/v1/oauth2/token"
+EBAY_SCOPE = "https://api.ebay.com/oauth/api_scope/sell.inventory"
+TOKEN_CACHE_PATH = Path(os.getenv('EBAY_TOKEN_CACHE', Path.home() / '.ebay_token.json'))
+TOKEN_EXPIRY_SKEW = 300  # renew five minutes before eBay says a token expires
+EBAY_MAX_WORKERS = 8
+EBAY_CALLS_PER_SECOND = 4
 EBAY_CREDENTIALS = {
     'client_id': os.getenv('EBAY_CLIENT_ID'),
     'client_secret': os.getenv('EBAY_CLIENT_SECRET'),
@@ -25,72 +41,93 @@ EBAY_CREDENTIALS = {
     }
 }
 
-# Binding Type Short Codes
-BINDING_SHORTCODES = {
-    # Exact match mappings
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',  # Alternate format
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',  # Alternate format
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}
-
-
+# Shared across worker threads; replaces the old fixed one-second sleep per item
+EBAY_RATE_LIMITER = TokenBucket(EBAY_CALLS_PER_SECOND)
+
+
+# VerifyAddItem request split into the markup that never changes, encoded once at
+# import; build_ebay_xml escapes the per-item fields and joins them in between
+EBAY_NS = {'ebay': 'urn:ebay:apis:eBLBaseComponents'}
+
+_REQUEST_HEAD = (
+    b"<?xml version='1.0' encoding='utf-8'?>\n"
+    b'<VerifyAddItemRequest xmlns="urn:ebay:apis:eBLBaseComponents">'
+    b"<RequesterCredentials><eBayAuthToken>"
+)
+
+_STATIC_SPECIFICS = (
+    b"<NameValueList><Name>Sport</Name><Value>Baseball</Value></NameValueList>"  # Hardcoded per example
+    b"<NameValueList><Name>Condition</Name><Value>Ungraded</Value></NameValueList>"
+)
+
+_STATIC_CONDITION_AND_CATEGORY = (
+    b"<ConditionDescriptors><ConditionDescriptor>"
+    b"<Name>40001</Name>"  # Condition type ID
+    b"<Value>Like New Or Better</Value>"  # Condition description
+    b"</ConditionDescriptor></ConditionDescriptors>"
+    b"<PrimaryCategory><CategoryID>29290</CategoryID><CategoryName>Books</CategoryName></PrimaryCategory>"
+)
+
+_STATIC_SHIPPING = (
+    b"<ShippingDetails>"
+    b"<ShippingDiscountProfileID>0</ShippingDiscountProfileID>"
+    b"<InternationalShippingDiscountProfileID>0</InternationalShippingDiscountProfileID>"
+    b"<ShippingPackageDetails>"
+    b"<MeasurementUnit>English</MeasurementUnit>"
+    b'<PackageDepth unit="in" measurementSystem="English">1</PackageDepth>'
+    b'<PackageLength unit="in" measurementSystem="English">1</PackageLength>'
+    b'<PackageWidth unit="in" measurementSystem="English">1</PackageWidth>'
+    b"<ShippingIrregular>false</ShippingIrregular>"
+    b"<ShippingPackage>PackageThickEnvelope</ShippingPackage>"
+    b'<WeightMajor unit="lbs">0</WeightMajor>'
+    b'<WeightMinor unit="oz">1</WeightMinor>'
+    b"</ShippingPackageDetails>"
+    b"</ShippingDetails>"
+)
+
+# The business policy ids are fixed for the process, so the profiles are static too
+_STATIC_SELLER_PROFILES = (
+    "<SellerProfiles>"
+    "<SellerPaymentProfile><PaymentProfileID>{payment}</PaymentProfileID></SellerPaymentProfile>"
+    "<SellerReturnProfile><ReturnProfileID>{returns}</ReturnProfileID></SellerReturnProfile>"
+    "<SellerShippingProfile><ShippingProfileID>{shipping}</ShippingProfileID></SellerShippingProfile>"
+    "</SellerProfiles>"
+).format(
+    payment=xml_safe(EBAY_CREDENTIALS['business_policies']['payment_policy_id'] or ''),
+    returns=EBAY_CREDENTIALS['business_policies']['return_policy_id'],
+    shipping=EBAY_CREDENTIALS['business_policies']['shipping_policy_id']
+).encode('utf-8')
+
+_STATIC_FOOTER = (
+    b"<ConditionID>4000</ConditionID>"  # Ungraded condition code
+    b"<ConditionDisplayName>Ungraded</ConditionDisplayName>"
+    b"<Country>GB</Country>"
+    b"<Currency>GBP</Currency>"
+    b"<DispatchTimeMax>3</DispatchTimeMax>"
+    b"<ListingDuration>GTC</ListingDuration>"
+    b"<ListingType>FixedPriceItem</ListingType>"
+    b"<PostalCode>PA145YU</PostalCode>"  # Replace with your postal code
+    b"<Site>UK</Site>"
+    b"</Item>"
+    b"</VerifyAddItemRequest>"
+)
+
+def _stripped_len(*parts):
+    """len(''.join(parts).strip()) without building the joined string"""
+    total = sum(map(len, parts))
+    for part in parts:
+        stripped = part.lstrip()
+        total -= len(part) - len(stripped)
+        if stripped:
+            break
+    else:
+        return 0
+    for part in reversed(parts):
+        stripped = part.rstrip()
+        total -= len(part) - len(stripped)
+        if stripped:
+            break
+    return total
 
 def generate_book_title(book_name, author, binding_type=None, publication_year=None, binding_codes=None):
     binding_codes = binding_codes or {}
@@ -110,277 +147,284 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
         else:
             binding_abbr = binding_codes.get(binding_type, binding_type)
 
-    # Build components dynamically
-    components = {
-        'book': book_name,
-        'by': "by",
-        'author': author,
-        'binding': binding_abbr,
-        'year': publication_year
-    }
+    # Each variation is kept as parts and measured with _stripped_len; only the
+    # first one that fits is joined into a string
+    year = f"{publication_year or ''}"
+    abbr = binding_abbr or ''
 
-    # Generate title variations in priority order
-    variations = []
-    
     # Variation 1: Full format with binding/year
-    variations.append(f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip())
-    
+    parts = (book_name, " by ", author, " ", binding_type or '', " Book ", year)
+    if _stripped_len(*parts) <= 65:
+        return ''.join(parts).strip()
+
     # Variation 2: Abbreviated binding
-    variations.append(f"{book_name} by {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
+    parts = (book_name, " by ", author, " ", abbr, " Book ", year)
+    if _stripped_len(*parts) <= 65:
+        return ''.join(parts).strip()
+
     # Variation 3: Remove "by"
-    variations.append(f"{book_name} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
+    parts = (book_name, " ", author, " ", abbr, " Book ", year)
+    if _stripped_len(*parts) <= 65:
+        return ''.join(parts).strip()
+
     # Variation 4: Truncate author
-    base_length = len(f"{book_name} ") + len(f" {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
+    base_length = len(book_name) + 1 + _stripped_len(" ", abbr, " Book ", year) + 1
     max_author_len = 65 - base_length - 1  # -1 for ellipsis
     if max_author_len >= 1:
-        truncated_author = truncate(author, max_author_len)
-        variations.append(f"{book_name} {truncated_author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
+        parts = (book_name, " ", truncate(author, max_author_len), " ", abbr, " Book ", year)
+        if _stripped_len(*parts) <= 65:
+            return ''.join(parts).strip()
+
     # Variation 5: Truncate book name
-    base_length = len(f" {author} {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
+    base_length = _stripped_len(" ", author, " ", abbr, " Book ", year) + 1
     max_book_len = 65 - base_length - 1  # -1 for ellipsis
     if max_book_len >= 1:
-        truncated_book = truncate(book_name, max_book_len)
-        variations.append(f"{truncated_book} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
-    # Find first valid variation
-    for title in variations:
-        if len(title) <= 65:
-            return title[:65]  # Ensure exact length
-    
+        parts = (truncate(book_name, max_book_len), " ", author, " ", abbr, " Book ", year)
+        if _stripped_len(*parts) <= 65:
+            return ''.join(parts).strip()
+
     # Final fallback: Book title only with ellipsis
     return truncate(book_name, 62).ljust(65, ellipsis)[:65]
 
-def extract_year(date_str):
-    """Extract year from various date formats"""
-    match = re.search(r'\b\d{4}\b', str(date_str))
-    return match.group(0) if match else None
+def _xml_bytes(text):
+    return xml_escape(text).encode('utf-8')
 
-
-def calculate_start_price(item , final_price):
-    """
-    Calculate listing price based on RRP, discount, and VAT
-    Returns rounded price or None if invalid data
-    """
-    try:
-                
-        vat_percent = (item['vat_code']).lower()
-        
-        if vat_percent == 'z':
-            vat_percent = float(0.0)
-        elif vat_percent == 's':
-            vat_percent = float(20.0)
-        else:
-            vat_percent = float(5.0)
-
-        # Validate input values
-        if any(val < 0 for val in [vat_percent]):
-            print(f"Invalid negative value in pricing data for item {item.get('id')}")
-            return None
-
-        net_price = final_price * (1 + (vat_percent / 100))
-        
-        # Return price rounded to 2 decimal places
-        return round(net_price, 2)
-    
-    except KeyError as e:
-        print(f"Missing required pricing field {e} for item {item.get('id')}")
-        return None
-    except (TypeError, ValueError) as e:
-        print(f"Invalid pricing data for item {item.get('id')}: {str(e)}")
-        return None
+def _render_specifics(specifics):
+    """Render (name, value) pairs as NameValueList elements; None entries are skipped"""
+    return ''.join(
+        f"<NameValueList><Name>{name}</Name><Value>{'' if value is None else xml_safe(str(value))}</Value></NameValueList>"
+        for name, value in filter(None, specifics)
+    ).encode('utf-8')
 
 def build_ebay_xml(item_data, access_token, calculated_price, title, binding_type, pub_year):
     """Build XML request matching the example structure"""
-    root = Element('VerifyAddItemRequest', xmlns='urn:ebay:apis:eBLBaseComponents')
-    
-    # Requester Credentials
-    requester = SubElement(root, 'RequesterCredentials')
-    SubElement(requester, 'eBayAuthToken').text = access_token
-    
-    # Item container
-    item = SubElement(root, 'Item')
-    
-    # Title and Description
-    SubElement(item, 'Title').text = title
-    SubElement(item, 'Description').text = item_data.get('description', 'No description available')
-    
-    # Pictures
-    if item_data.get('cover_image'):
-        pic_details = SubElement(item, 'PictureDetails')
-        SubElement(pic_details, 'PictureURL').text = item_data['cover_image']
-    
-    # Item Specifics
-    specifics = SubElement(item, 'ItemSpecifics')
-    spec_data = [
-        ('Sport', ['Baseball']),  # Hardcoded per example
-        ('Condition', ['Ungraded']),
-        ('Publication Year', [pub_year]) if pub_year else None,
-        ('Author', [item_data['author']]),
-        ('Publisher', [item_data.get('publisher', 'Unknown')])
-    ]
-    
-    for entry in filter(None, spec_data):
-        nv_list = SubElement(specifics, 'NameValueList')
-        SubElement(nv_list, 'Name').text = entry[0]
-        SubElement(nv_list, 'Value').text = entry[1][0]
-
-    # Condition Descriptors (from example)
-    cond_desc = SubElement(item, 'ConditionDescriptors')
-    descriptor = SubElement(cond_desc, 'ConditionDescriptor')
-    SubElement(descriptor, 'Name').text = '40001'  # Condition type ID
-    SubElement(descriptor, 'Value').text = 'Like New Or Better'  # Condition description
-
-    # Category Information (baseball cards category from example)
-    primary_cat = SubElement(item, 'PrimaryCategory')
-    SubElement(primary_cat, 'CategoryID').text = '29290'
-    SubElement(primary_cat, 'CategoryName').text = 'Books'
-
-    # Pricing and Quantity
-    SubElement(item, 'StartPrice').text = f"{calculated_price:.2f}"
-    SubElement(item, 'CategoryMappingAllowed').text = 'true'
-    SubElement(item, 'Quantity').text = str(item_data['stock'])
-
-    # Shipping Configuration (from example)
-    shipping = SubElement(item, 'ShippingDetails')
-    SubElement(shipping, 'ShippingDiscountProfileID').text = '0'
-    SubElement(shipping, 'InternationalShippingDiscountProfileID').text = '0'
-    
-    pkg_details = SubElement(shipping, 'ShippingPackageDetails')
-    SubElement(pkg_details, 'MeasurementUnit').text = 'English'
-    SubElement(pkg_details, 'PackageDepth', {'unit':'in', 'measurementSystem':'English'}).text = '1'
-    SubElement(pkg_details, 'PackageLength', {'unit':'in', 'measurementSystem':'English'}).text = '1'
-    SubElement(pkg_details, 'PackageWidth', {'unit':'in', 'measurementSystem':'English'}).text = '1'
-    SubElement(pkg_details, 'ShippingIrregular').text = 'false'
-    SubElement(pkg_details, 'ShippingPackage').text = 'PackageThickEnvelope'
-    SubElement(pkg_details, 'WeightMajor', {'unit':'lbs'}).text = '0'
-    SubElement(pkg_details, 'WeightMinor', {'unit':'oz'}).text = '1'
-
-    # Seller Profiles (from example structure)
-    seller_profiles = SubElement(item, 'SellerProfiles')
-    
-    payment_profile = SubElement(seller_profiles, 'SellerPaymentProfile')
-    SubElement(payment_profile, 'PaymentProfileID').text = EBAY_CREDENTIALS['business_policies']['payment_policy_id']
-    
-    return_profile = SubElement(seller_profiles, 'SellerReturnProfile')
-    SubElement(return_profile, 'ReturnProfileID').text = EBAY_CREDENTIALS['business_policies']['return_policy_id']
-    
-    shipping_profile = SubElement(seller_profiles, 'SellerShippingProfile')
-    SubElement(shipping_profile, 'ShippingProfileID').text = EBAY_CREDENTIALS['business_policies']['shipping_policy_id']
-
-    # Required Fields from Example
-    SubElement(item, 'ConditionID').text = '4000'  # Ungraded condition code
-    SubElement(item, 'ConditionDisplayName').text = 'Ungraded'
-    SubElement(item, 'Country').text = 'GB'
-    SubElement(item, 'Currency').text = 'GBP'
-    SubElement(item, 'DispatchTimeMax').text = '3'
-    SubElement(item, 'ListingDuration').text = 'GTC'
-    SubElement(item, 'ListingType').text = 'FixedPriceItem'
-    SubElement(item, 'PostalCode').text = 'PA145YU'  # Replace with your postal code
-    SubElement(item, 'Site').text = 'UK'
-
-    return ET.tostring(root, encoding='utf-8', method='xml')
-
-def main():
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    cover_image = item_data.cover_image
+    return b''.join([
+        _REQUEST_HEAD, _xml_bytes(access_token),
+        b"</eBayAuthToken></RequesterCredentials><Item><Title>", _xml_bytes(title),
+        b"</Title><Description>", _xml_bytes(item_data.description or ""),
+        b"</Description>",
+        b"<PictureDetails><PictureURL>" + _xml_bytes(cover_image) + b"</PictureURL></PictureDetails>" if cover_image else b"",
+        b"<ItemSpecifics>", _STATIC_SPECIFICS,
+        _render_specifics([
+            ('Publication Year', pub_year) if pub_year else None,
+            ('Author', item_data.author),
+            ('Publisher', item_data.publisher)
+        ]),
+        b"</ItemSpecifics>", _STATIC_CONDITION_AND_CATEGORY,
+        b"<StartPrice>", f"{calculated_price:.2f}".encode('ascii'), b"</StartPrice>",
+        b"<CategoryMappingAllowed>true</CategoryMappingAllowed>",
+        b"<Quantity>", xml_safe(str(item_data.stock)).encode('utf-8'), b"</Quantity>",
+        _STATIC_SHIPPING, _STATIC_SELLER_PROFILES, _STATIC_FOOTER
+    ])
+
+@functools.cache
+def _basic_auth():
+    """OAuth client credentials header; the id and secret are fixed for the process"""
+    return "Basic " + base64.b64encode(
+        f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode('ascii')
+    ).decode('ascii')
+
+_token_cache = None
+_token_lock = threading.Lock()
+
+def _request_token(session, data):
+    """POST to the OAuth token endpoint and return the parsed token response"""
+    response = session.post(
+        EBAY_TOKEN_URL,
+        headers={
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": _basic_auth()
+        },
+        data=data
+    )
+    response.raise_for_status()
+    return response.json()
 
-    # eBay OAuth Flow
-    auth_url = f"https://auth.ebay.com/oauth2/authorize?client_id={EBAY_CREDENTIALS['client_id']}&redirect_uri={urllib.parse.quote(EBAY_CREDENTIALS['redirect_uri'])}&response_type=code&scope=https://api.ebay.com/oauth/api_scope/sell.inventory"
+def _authorize_interactively():
+    """Full consent flow: the operator opens the URL and pastes back the redirect"""
+    auth_url = f"https://auth.ebay.com/oauth2/authorize?client_id={EBAY_CREDENTIALS['client_id']}&redirect_uri={urllib.parse.quote(EBAY_CREDENTIALS['redirect_uri'])}&response_type=code&scope={EBAY_SCOPE}"
     print(f"Authorize here: {auth_url}")
     redirect_url = input("Paste redirect URL after authorization: ")
     code = urllib.parse.parse_qs(urllib.parse.urlparse(redirect_url).query)['code'][0]
-
-    # Get access token
-    token_response = requests.post(
-        "https://api.ebay.com/identity/v1/oauth2/token",
-        headers={
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": "Basic " + base64.b64encode(
-                f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode()
-            ).decode()
-        },
-        data={
+    # The code is single-use: a retry after eBay has consumed it fails with invalid_grant
+    # and hides the real error, so this exchange goes over a plain, non-retrying session
+    with requests.Session() as plain_session:
+        return _request_token(plain_session, {
             "grant_type": "authorization_code",
             "code": code,
             "redirect_uri": EBAY_CREDENTIALS['redirect_uri']
-        }
+        })
+
+def _load_token_cache():
+    try:
+        return json.loads(TOKEN_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _save_token_cache(cache):
+    """Write the token cache readable by the owner only"""
+    fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+
+def get_access_token(session):
+    """
+    Return a valid access token. The cached token is reused until shortly before it
+    expires, then renewed with the stored refresh token; the browser flow only runs
+    when there is no usable refresh token.
+    """
+    global _token_cache
+    with _token_lock:
+        if _token_cache is None:
+            _token_cache = _load_token_cache()
+        cache = _token_cache
+        now = time.time()
+        if cache.get('access_token') and cache.get('expires_at', 0) - TOKEN_EXPIRY_SKEW > now:
+            return cache['access_token']
+
+        token = None
+        if cache.get('refresh_token') and cache.get('refresh_expires_at', 0) - TOKEN_EXPIRY_SKEW > now:
+            try:
+                token = _request_token(session, {
+                    "grant_type": "refresh_token",
+                    "refresh_token": cache['refresh_token'],
+                    "scope": EBAY_SCOPE
+                })
+            except requests.RequestException as e:
+                print(f"Token refresh failed, authorizing again: {e}")
+        if token is None:
+            token = _authorize_interactively()
+            cache['refresh_token'] = token['refresh_token']
+            cache['refresh_expires_at'] = now + token['refresh_token_expires_in']
+
+        cache['access_token'] = token['access_token']
+        cache['expires_at'] = now + token['expires_in']
+        _save_token_cache(cache)
+        return cache['access_token']
+
+def create_session():
+    """One pooled keep-alive session for token refreshes and every Trading API call"""
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({'POST'})  # VerifyAddItem and refresh-token grants are safe to repeat
     )
-    access_token = token_response.json()['access_token']
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    session.headers.update({
+        'X-EBAY-API-COMPATIBILITY-LEVEL': '1245',
+        'X-EBAY-API-CALL-NAME': 'VerifyAddItem',
+        'X-EBAY-API-SITEID': '3',
+        'Content-Type': 'text/xml'
+    })
+    return session
+
+def iter_inventory(supabase, page_size=INVENTORY_PAGE_SIZE):
+    """Stream inventory rows page by page so listing starts after the first page"""
+    start = 0
+    while True:
+        rows = (supabase.table(table_name).select(LISTING_COLUMNS)
+                .order('id')
+                .range(start, start + page_size - 1)
+                .execute().data)
+        yield from listings_from_rows(rows)
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+def read_ack(content):
+    """
+    Stream the response only as far as Ack and ItemID, which eBay sends near the top;
+    the rest of the document is never built into a tree
+    """
+    ack = item_id = None
+    for _, elem in etree.iterparse(io.BytesIO(content), events=('end',)):
+        tag = etree.QName(elem).localname
+        if tag == 'Ack':
+            ack = elem.text
+        elif tag == 'ItemID':
+            item_id = elem.text
+            break
+        elem.clear()
+    return ack, item_id
+
+def verify_item(session, item):
+    """Runs on a worker thread: title, price, build XML and verify one item; returns 1 on success"""
+    try:
+        # Generate listing details
+        binding = item.binding
+        pub_year = item.pub_year
+        title = generate_book_title(
+            item.title,
+            item.author,
+            binding,
+            pub_year,
+            BINDING_SHORTCODES
+        )
+
+        # Calculate price
+        calculated_price = calculate_start_price(item)
+        
+        if not calculated_price or calculated_price < 0.99:
+            print(f"Skipping item {item.id} - invalid price")
+            return 0
+
+        # Build XML request
+        xml_data = build_ebay_xml(
+            item_data=item,
+            access_token=get_access_token(session),
+            calculated_price=calculated_price,
+            title=title,
+            binding_type=binding,
+            pub_year=pub_year
+        )
+
+        # Send request to eBay (Trading API headers are set on the session)
+        EBAY_RATE_LIMITER.acquire()
+        response = session.post(
+            'https://api.ebay.com/ws/api.dll',
+            data=xml_data
+        )
+
+        # Process response
+        if response.status_code == 200:
+            ack, item_id = read_ack(response.content)
+            if ack in ['Success', 'Warning']:
+                print(f"Successfully listed: {title} (ID: {item_id})")
+                return 1
+            # Failures are rare, so only they pay for a full parse to collect the errors
+            response_root = etree.fromstring(response.content)
+            for message in response_root.iterfind('ebay:Errors/ebay:LongMessage', namespaces=EBAY_NS):
+                print(f"Error: {message.text}")
+        else:
+            print(f"API Error: {response.status_code} - {response.text}")
+
+    except Exception as e:
+        print(f"Failed to process item {item.id}: {str(e)}")
+    return 0
+
+def main():
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    session = create_session()
+    get_access_token(session)  # prompts here, before the workers start, if ever needed
 
     success_count = 0
-    inventory = supabase.table(table_name).select('*').execute().data
-
-    for item in inventory:
-        try:
-            # Generate listing details
-            binding = item.get('binding', 'Unknown')
-            pub_year = extract_year(item.get('publication_year'))
-            title = generate_book_title(
-                item['title'],
-                item['author'],
-                binding,
-                pub_year,
-                BINDING_SHORTCODES
-            )
-
-            # Calculate price
-            calculated_price_vat_excl = inclusive_price(item)
-            calculated_price = calculate_start_price(item, calculated_price_vat_excl)
-            
-            if not calculated_price or calculated_price < 0.99:
-                print(f"Skipping item {item.get('id')} - invalid price")
-                continue
-
-            # Build XML request
-            xml_data = build_ebay_xml(
-                item_data=item,
-                access_token=access_token,
-                calculated_price=calculated_price,
-                title=title,
-                binding_type=binding,
-                pub_year=pub_year
-            )
-
-            print(xml_data)
-
-            # Send request to eBay
-            headers = {
-                'X-EBAY-API-COMPATIBILITY-LEVEL': '1245',
-                'X-EBAY-API-CALL-NAME': 'VerifyAddItem',
-                'X-EBAY-API-SITEID': '3',
-                'Content-Type': 'text/xml'
-            }
-            
-            response = requests.post(
-                'https://api.ebay.com/ws/api.dll',
-                data=xml_data,
-                headers=headers
-            )
-
-            # Process response
-            if response.status_code == 200:
-                response_root = ET.fromstring(response.content)
-                ack = response_root.find('Ack').text
-                if ack in ['Success', 'Warning']:
-                    item_id = response_root.find('ItemID').text
-                    print(f"Successfully listed: {title} (ID: {item_id})")
-                    success_count += 1
-                else:
-                    errors = response_root.findall('Errors')
-                    for error in errors:
-                        print(f"Error: {error.find('LongMessage').text}")
-            else:
-                print(f"API Error: {response.status_code} - {response.text}")
-
-            time.sleep(1)  # Rate limiting
-
-        except Exception as e:
-            print(f"Failed to process item {item.get('id')}: {str(e)}")
-            continue
+    pending = set()
+    with ThreadPoolExecutor(max_workers=EBAY_MAX_WORKERS) as executor:
+        # The next page is fetched while the current one is being verified
+        for item in prefetch(iter_inventory(supabase), INVENTORY_PAGE_SIZE):
+            # Keep a bounded number of calls in flight while the inventory streams in
+            if len(pending) >= EBAY_MAX_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                success_count += sum(future.result() for future in done)
+            pending.add(executor.submit(verify_item, session, item))
+
+        for future in as_completed(pending):
+            success_count += future.result()
 
     print(f"Successfully listed {success_count} items")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,13 +2,14 @@ import requests
 import urllib.parse
 import base64
 import re
-import time
 from supabase import create_client, Client
 from ebaysdk.trading import Connection
 from ebaysdk.exception import ConnectionError
 from ebaysdk.utils import dict2xml
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_PATTERNS, BINDING_SHORTCODES
+from calculate_price import REDUCED_VAT_MULTIPLIER, VAT_MULTIPLIERS, inclusive_price
+from rate_limiter import TokenBucket
 from xml.sax.saxutils import escape
 
 
@@ -29,70 +30,25 @@ EBAY_CREDENTIALS = {
     }
 }
 
-# Binding Type Short Codes
-BINDING_SHORTCODES = {
-    # Exact match mappings
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',  # Alternate format
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',  # Alternate format
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}
+# Caps calls at one per second without sleeping when the last call already took that long
+EBAY_RATE_LIMITER = TokenBucket(1)
+
+# Compiled once at import rather than looked up in the re cache for every item
+_YEAR_RE = re.compile(r'\b\d{4}\b')
+_BY_RE = re.compile(r'\bby\b')
+
+# ItemSpecifics rendered straight to XML: dict2xml passes a string value through
+# as-is, so only the values are filled in per item instead of building
+# a Name/Value dict and list for each entry
+_ITEM_SPECIFICS = (
+    "<NameValueList><Name>Title</Name><Value>{title}</Value></NameValueList>"
+    "<NameValueList><Name>Author</Name><Value>{author}</Value></NameValueList>"
+    "<NameValueList><Name>Binding</Name><Value>{binding}</Value></NameValueList>"
+    "<NameValueList><Name>Language</Name><Value>{language}</Value></NameValueList>"
+    "<NameValueList><Name>ISBN</Name><Value>{isbn}</Value></NameValueList>"
+    "<NameValueList><Name>Publisher</Name><Value>{publisher}</Value></NameValueList>"
+)
+_PUBLICATION_YEAR_SPECIFIC = "<NameValueList><Name>Publication Year</Name><Value>{}</Value></NameValueList>"
 
 
 
@@ -120,7 +76,7 @@ def generate_book_title(
 
     def clean(s):
         # collapse any extra spaces
-        return re.sub(r'\s+', ' ', s).strip()
+        return ' '.join(s.split())
 
     title = clean(title)
     if len(title) <= max_len:
@@ -137,17 +93,14 @@ def generate_book_title(
     # 3) convert binding to code
     if binding_type and binding_type in code_map:
         # replace the full word with its code
-        title = re.sub(
-            r'\b' + re.escape(binding_type) + r'\b',
-            code_map[binding_type],
-            title
-        )
+        pattern = BINDING_PATTERNS.get(binding_type) or re.compile(r'\b' + re.escape(binding_type) + r'\b')
+        title = pattern.sub(code_map[binding_type], title)
         title = clean(title)
         if len(title) <= max_len:
             return title
 
     # 4) remove "by"
-    title = re.sub(r'\bby\b', '', title)
+    title = _BY_RE.sub('', title)
     title = clean(title)
     if len(title) <= max_len:
         return title
@@ -169,7 +122,7 @@ def generate_book_title(
 
 def extract_year(date_str):
     """Extract year from various date formats"""
-    match = re.search(r'\b\d{4}\b', str(date_str))
+    match = _YEAR_RE.search(str(date_str))
     return match.group(0) if match else None
 
 
@@ -179,25 +132,10 @@ def calculate_start_price(item , final_price):
     Returns rounded price or None if invalid data
     """
     try:
-                
-        vat_percent = (item['vat_code']).lower()
-        
-        if vat_percent == 'z':
-            vat_percent = float(0.0)
-        elif vat_percent == 's':
-            vat_percent = float(20.0)
-        else:
-            vat_percent = float(5.0)
+        multiplier = VAT_MULTIPLIERS.get(item['vat_code'].lower(), REDUCED_VAT_MULTIPLIER)
 
-        # Validate input values
-        if any(val < 0 for val in [vat_percent]):
-            print(f"Invalid negative value in pricing data for item {item.get('id')}")
-            return None
-
-        net_price = final_price * (1 + (vat_percent / 100))
-        
         # Return price rounded to 2 decimal places
-        return round(net_price, 2)
+        return round(final_price * multiplier, 2)
     
     except KeyError as e:
         print(f"Missing required pricing field {e} for item {item.get('id')}")
@@ -290,16 +228,14 @@ def main():
         "Quantity": str(item['stock']),
         "Location": "Port Glasgow",
         "PostalCode": "PA145YU",
-        "ItemSpecifics": {
-                        "NameValueList": [
-                            {"Name": "Title", "Value": [title]},
-                            {"Name": "Author", "Value": [item['author'].split()[-1]]},
-                            {"Name": "Binding", "Value": [binding]},
-                            {"Name": "Language", "Value": [language]},
-                            {"Name": "ISBN", "Value": [item.get('isbn13', 'Unknown')]},
-                            {"Name": "Publisher", "Value": [item.get('publisher', 'Unknown')]}
-                        ]
-                    },
+        "ItemSpecifics": _ITEM_SPECIFICS.format(
+                        title=title,
+                        author=item['author'].split()[-1],
+                        binding=binding,
+                        language=language,
+                        isbn=item.get('isbn13', 'Unknown'),
+                        publisher=item.get('publisher', 'Unknown')
+                    ) + (_PUBLICATION_YEAR_SPECIFIC.format(pub_year) if pub_year else ""),
                 
         "BusinessPolicies": {
                         
@@ -329,12 +265,6 @@ def main():
     }
 }
 
-            # Add publication year if available
-            if pub_year:
-                payload["Item"]["ItemSpecifics"]["NameValueList"].append(
-                    {"Name": "Publication Year", "Value": [pub_year]}
-                )
-
             # Add image if available
             if item.get('cover_image'):
                 payload["Item"]["PictureDetails"] = {"PictureURL": [item['cover_image']]}
@@ -353,15 +283,15 @@ def main():
 
             # Submit listing
             print(f"{payload}\n\n")
+            EBAY_RATE_LIMITER.acquire()
             response = connection.execute('AddFixedPriceItem', payload)
             success_count += 1
             
-            if response.dict()['Ack'] == 'Warning':
-                print(f"Successfully listed: {title} (ID: {response.dict()['ItemID']})")
+            reply = response.dict()
+            if reply['Ack'] == 'Warning':
+                print(f"Successfully listed: {title} (ID: {reply['ItemID']})")
             else:
-                print(f"Error listing {title}: {response.dict().get('Errors', 'Unknown error')}")
-            
-            time.sleep(1)  # Rate limit
+                print(f"Error listing {title}: {reply.get('Errors', 'Unknown error')}")
 
         except Exception as e:
             print(f"Failed to process item {item.get('id')}: {str(e)}")
@@ -6,10 +6,11 @@ import time
 from supabase import create_client, Client
 from ebaysdk.trading import Connection
 from ebaysdk.exception import ConnectionError
-from ebaysdk.utils import dict2xml
-from xml.sax.saxutils import escape
+from string import Template
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_PATTERNS, BINDING_SHORTCODES
+from calculate_price import REDUCED_VAT_MULTIPLIER, VAT_MULTIPLIERS, inclusive_price
+from listing_common import xml_safe
 
 # Configuration
 table_name = os.getenv('SUPABASE_TABLE_NAME')
@@ -27,70 +28,9 @@ EBAY_CREDENTIALS = {
     }
 }
 
-# Binding Type Short Codes
-BINDING_SHORTCODES = {
-    # Exact match mappings
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',  # Alternate format
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',  # Alternate format
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}  # (unchanged for brevity)
+# Compiled once at import rather than looked up in the re cache for every item
+_YEAR_RE = re.compile(r'\b\d{4}\b')
+_BY_RE = re.compile(r'\bby\b')
 
 
 def generate_book_title(book_name, author, binding_type=None, publication_year=None, binding_codes=None, max_len=65):
@@ -103,8 +43,7 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
         parts += [binding_type, 'Book']
     if publication_year:
         parts.append(str(publication_year))
-    title = ' '.join(parts)
-    title = re.sub(r'\s+', ' ', title).strip()
+    title = ' '.join(' '.join(parts).split())
     if len(title) <= max_len:
         return title
 
@@ -114,11 +53,12 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
             return title
 
     if binding_type and binding_type in code_map:
-        title = re.sub(r'\b' + re.escape(binding_type) + r'\b', code_map[binding_type], title).strip()
+        pattern = BINDING_PATTERNS.get(binding_type) or re.compile(r'\b' + re.escape(binding_type) + r'\b')
+        title = pattern.sub(code_map[binding_type], title).strip()
         if len(title) <= max_len:
             return title
 
-    title = re.sub(r'\bby\b', '', title).strip()
+    title = _BY_RE.sub('', title).strip()
     if len(title) <= max_len:
         return title
 
@@ -135,26 +75,64 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
 
 
 def extract_year(date_str):
-    match = re.search(r'\b\d{4}\b', str(date_str))
+    match = _YEAR_RE.search(str(date_str))
     return match.group(0) if match else None
 
 
 def calculate_start_price(item, final_price):
     try:
-        vat_code = item.get('vat_code', 's').lower()
-        vat_percent = {'z': 0.0, 's': 20.0}.get(vat_code, 5.0)
-        if vat_percent < 0:
-            print(f"Invalid VAT for item {item.get('id')}")
-            return None
-        net_price = final_price * (1 + vat_percent/100)
-        return round(net_price, 2)
+        multiplier = VAT_MULTIPLIERS.get(item.get('vat_code', 's').lower(), REDUCED_VAT_MULTIPLIER)
+        return round(final_price * multiplier, 2)
     except Exception as e:
         print(f"Price calc error for {item.get('id')}: {e}")
         return None
 
 
-def xml_safe(text):
-    return escape(text, {"\"": "&quot;", "'": "&apos;"})
+# AddFixedPriceItem <Item>, in the element order dict2xml used to produce; only the
+# $-fields change per item, and every one of them is XML-escaped by the caller
+_ITEM_TEMPLATE = Template(
+    "<Item>"
+    "<BusinessPolicies><PaymentPolicyID>$payment_policy</PaymentPolicyID></BusinessPolicies>"
+    "<CategoryMappingAllowed>true</CategoryMappingAllowed>"
+    "<ConditionID>1000</ConditionID>"
+    "<Country>GB</Country>"
+    "<Currency>GBP</Currency>"
+    "<Description><![CDATA[$description]]></Description>"
+    "<DispatchTimeMax>1</DispatchTimeMax>"
+    "<ItemSpecifics>"
+    "<NameValueList><Name>Title</Name><Value>$title</Value></NameValueList>"
+    "<NameValueList><Name>Author</Name><Value>$author</Value></NameValueList>"
+    "<NameValueList><Name>Binding</Name><Value>$binding</Value></NameValueList>"
+    "<NameValueList><Name>Language</Name><Value>$language</Value></NameValueList>"
+    "<NameValueList><Name>ISBN</Name><Value>$isbn</Value></NameValueList>"
+    "<NameValueList><Name>Publisher</Name><Value>$publisher</Value></NameValueList>"
+    "$publication_year"
+    "</ItemSpecifics>"
+    "<ListingDuration>GTC</ListingDuration>"
+    "<ListingType>FixedPriceItem</ListingType>"
+    "<Location>Port Glasgow</Location>"
+    "$picture_details"
+    "<PostalCode>PA145YU</PostalCode>"
+    "<PrimaryCategory><CategoryID>261186</CategoryID></PrimaryCategory>"
+    "<ProductListingDetails><ISBN>$isbn</ISBN></ProductListingDetails>"
+    "<Quantity>$quantity</Quantity>"
+    "<ReturnPolicy>"
+    "<RefundOption>MoneyBack</RefundOption>"
+    "<ReturnsAcceptedOption>ReturnsAccepted</ReturnsAcceptedOption>"
+    "<ReturnsWithinOption>Days_30</ReturnsWithinOption>"
+    "<ShippingCostPaidByOption>Buyer</ShippingCostPaidByOption>"
+    "</ReturnPolicy>"
+    "<ShippingDetails><ShippingServiceOptions>"
+    "<FreeShipping>false</FreeShipping>"
+    "<ShippingService>UK_RoyalMailSecondClassStandard</ShippingService>"
+    "<ShippingServiceAdditionalCost>0.00</ShippingServiceAdditionalCost>"
+    "<ShippingServiceCost>3.00</ShippingServiceCost>"
+    "<ShippingServicePriority>1</ShippingServicePriority>"
+    "</ShippingServiceOptions></ShippingDetails>"
+    "<StartPrice>$start_price</StartPrice>"
+    "<Title>$title</Title>"
+    "</Item>"
+)
 
 
 def main():
@@ -193,6 +171,7 @@ def main():
     for item in inventory:
         if success_count >= 150:
             break
+        item_xml = None
         try:
             language = 'English' if item.get('language', 'en') == 'en' else item.get('language')
             pub_year = extract_year(item.get('publication_year'))
@@ -205,57 +184,40 @@ def main():
             isbn_val = xml_safe(item.get('isbn13', 'Unknown'))
             publisher_val = xml_safe(item.get('publisher', 'Unknown'))
 
-            payload = {
-                "Item": {
-                    "Title": safe_title,
-                    "Description": f"<![CDATA[{item.get('description', 'No description available')}]]>",
-                    "PrimaryCategory": {"CategoryID": "261186"},
-                    "StartPrice": "9.99",
-                    "CategoryMappingAllowed": "true",
-                    "Country": "GB",
-                    "Currency": "GBP",
-                    "ConditionID": "1000",
-                    "DispatchTimeMax": "1",
-                    "ListingDuration": "GTC",
-                    "ListingType": "FixedPriceItem",
-                    "Quantity": str(item['stock']),
-                    "Location": xml_safe("Port Glasgow"),
-                    "PostalCode": xml_safe("PA145YU"),
-                    "ItemSpecifics": {
-                        "NameValueList": [
-                            {"Name": "Title", "Value": [safe_title]},
-                            {"Name": "Author", "Value": [author_val]},
-                            {"Name": "Binding", "Value": [binding_val]},
-                            {"Name": "Language", "Value": [xml_safe(language)]},
-                            {"Name": "ISBN", "Value": [isbn_val]},
-                            {"Name": "Publisher", "Value": [publisher_val]}
-                        ]
-                    },
-                    "BusinessPolicies": {"PaymentPolicyID": EBAY_CREDENTIALS['business_policies']['payment']},
-                    "ReturnPolicy": {"ReturnsAcceptedOption": "ReturnsAccepted", "RefundOption": "MoneyBack", "ReturnsWithinOption": "Days_30", "ShippingCostPaidByOption": "Buyer"},
-                    "ShippingDetails": {"ShippingServiceOptions": {"ShippingServicePriority": "1", "ShippingService": "UK_RoyalMailSecondClassStandard", "ShippingServiceCost": "3.00", "FreeShipping": "false", "ShippingServiceAdditionalCost": "0.00"}},
-                    "ProductListingDetails": {"ISBN": isbn_val}
-                }
-            }
-
-            if pub_year:
-                payload["Item"]["ItemSpecifics"]["NameValueList"].append({"Name": "Publication Year", "Value": [xml_safe(pub_year)]})
-            if item.get('cover_image'):
-                payload["Item"]["PictureDetails"] = {"PictureURL": [item['cover_image']]}  # URLs are safe
-
             vat_excl = inclusive_price(item)
             start_price = calculate_start_price(item, vat_excl)
             if not start_price or start_price < 0.99:
                 continue
-            payload["Item"]["StartPrice"] = f"{start_price:.2f}"
 
-            response = connection.execute('AddFixedPriceItem', payload)
-            if response.dict().get('Ack') == 'Warning':
-                print(f"Successfully listed: {safe_title} (ID: {response.dict()['ItemID']})")
+            item_xml = _ITEM_TEMPLATE.substitute(
+                title=safe_title,
+                description=item.get('description', 'No description available'),
+                start_price=f"{start_price:.2f}",
+                quantity=xml_safe(str(item['stock'])),
+                author=author_val,
+                binding=binding_val,
+                language=xml_safe(language),
+                isbn=isbn_val,
+                publisher=publisher_val,
+                publication_year=(
+                    f"<NameValueList><Name>Publication Year</Name><Value>{xml_safe(pub_year)}</Value></NameValueList>"
+                    if pub_year else ""
+                ),
+                payment_policy=xml_safe(str(EBAY_CREDENTIALS['business_policies']['payment'])),
+                picture_details=(
+                    f"<PictureDetails><PictureURL>{xml_safe(item['cover_image'])}</PictureURL></PictureDetails>"
+                    if item.get('cover_image') else ""
+                )
+            )
+
+            response = connection.execute('AddFixedPriceItem', item_xml)
+            reply = response.dict()
+            if reply.get('Ack') == 'Warning':
+                print(f"Successfully listed: {safe_title} (ID: {reply['ItemID']})")
                 success_count += 1
                 print("Total successful listings:", success_count)
         except Exception as e:
-            print(f"{payload}\n\n")
+            print(f"{item_xml}\n\n")
             print(f"Failed item {item.get('id')}: {e}")
 
 
@@ -1,15 +1,26 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
 import base64
-import re
+import functools
+import io
 import time
+import threading
+import logging
+import logging.handlers
+import queue
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from supabase import create_client, Client
-from ebaysdk.trading import Connection
-from ebaysdk.exception import ConnectionError
-from ebaysdk.utils import dict2xml
-from xml.sax.saxutils import escape
+from lxml import etree
+from string import Template
 import os
-from calculate_price import inclusive_price
+from listing_common import (
+    LISTING_COLUMNS, Listing, calculate_start_price, generate_book_title, listings_from_rows,
+    sanitize_description, stock_visiblity, xml_safe
+)
+from prefetch import prefetch
+from rate_limiter import TokenBucket
 from typing import List
 
 # Configuration
@@ -17,6 +28,11 @@ RUN_SCRIPT = os.getenv('RUN_SCRIPT')
 table_name = os.getenv('SUPABASE_TABLE_NAME')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+INVENTORY_PAGE_SIZE = 1000
+LISTED_BATCH_SIZE = 200  # ids per bulk listed=TRUE update
+MIN_START_PRICE = 0.99
+EBAY_MAX_WORKERS = 8
+EBAY_CALLS_PER_SECOND = 4
 EBAY_CREDENTIALS = {
     'client_id': os.getenv('EBAY_CLIENT_ID'),
     'client_secret': os.getenv('EBAY_CLIENT_SECRET'),
@@ -33,156 +49,34 @@ refresh_token = os.getenv('REFRESH_TOKEN')
 TOKEN_LIFESPAN = 1.55 * 3600
 
 access_token = None
-token_obtained_ts = 0.0
-
-# Binding Type Short Codes
-BINDING_SHORTCODES = {
-    # Exact match mappings
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',  # Alternate format
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',  # Alternate format
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}  # (unchanged for brevity)
-
-
-def generate_book_title(
-    book_name: str = '',
-    author: str = '',
-    binding_type: str = None,
-    publication_year: str = None,
-    binding_codes: dict = None,
-    max_len: int = 65
-) -> str:
-    """
-    Construct a concise title from available info. Missing fields are skipped gracefully.
-    """
-    binding_codes = binding_codes or {}
-    default_map = {'Paperback': 'Pb', 'Hardcover': 'Hc'}
-    code_map = {**default_map, **binding_codes}
-
-    parts: List[str] = []
-    # Add book name
-    if book_name:
-        parts.append(book_name)
-    # Add author
-    if author:
-        parts.extend(['by', author])
-    # Add binding type
-    if binding_type:
-        parts.extend([binding_type, 'Book'])
-    # Add publication year
-    if publication_year:
-        parts.append(str(publication_year))
-
-    # Join and normalize whitespace
-    title = ' '.join(parts)
-    title = re.sub(r'\s+', ' ', title).strip()
-
-    # If within limits, return early
-    if len(title) <= max_len:
-        return title
-
-    # Remove publication year if too long
-    if publication_year and title.endswith(str(publication_year)):
-        title = title[:-(len(str(publication_year))+1)].strip()
-        if len(title) <= max_len:
-            return title
-
-    # Replace binding_type with shortcode
-    if binding_type and binding_type in code_map:
-        title = re.sub(
-            rf'\b{re.escape(binding_type)}\b',
-            code_map[binding_type],
-            title
-        ).strip()
-        if len(title) <= max_len:
-            return title
-
-    # Remove 'by' to shorten
-    title_no_by = re.sub(r'\bby\b', '', title).strip()
-    if len(title_no_by) <= max_len:
-        return title_no_by
-
-    # Abbreviate author
-    if author:
-        names = author.split()
-        if len(names) > 1:
-            abbr_author = names[0][0] + '. ' + ' '.join(names[1:])
-        else:
-            abbr_author = names[0][0] + '.'
-        title = title.replace(author, abbr_author).strip()
-        if len(title) <= max_len:
-            return title
-
-    # Fallback to hard truncate
-    return title[:max_len-3].rstrip() + '...'
+token_expires_at = 0.0  # time.monotonic() deadline for access_token
+_token_lock = threading.Lock()
+
+# Worker threads only enqueue records; setup_logging's listener thread writes them out
+logger = logging.getLogger('ebay')
+
+# Shared across worker threads
+EBAY_RATE_LIMITER = TokenBucket(EBAY_CALLS_PER_SECOND)
+
+TRADING_API_URL = 'https://api.ebay.com/ws/api.dll'
+# eBay error codes for a rejected or expired auth token
+TOKEN_ERROR_CODES = {'931', '932', '21917053'}
+
+@functools.cache
+def _basic_auth():
+    """OAuth client credentials header; the id and secret are fixed for the process"""
+    return "Basic " + base64.b64encode(
+        f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode('ascii')
+    ).decode('ascii')
 
 
 def refresh_access_token():
-    global access_token, token_obtained_ts, connection
-    resp = requests.post(
+    global access_token, token_expires_at
+    resp = _SESSION.post(
         "https://api.ebay.com/identity/v1/oauth2/token",
         headers={
             "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": "Basic " + base64.b64encode(
-                f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode()
-            ).decode()
+            "Authorization": _basic_auth()
         },
         data={
             "grant_type":     "refresh_token",
@@ -192,234 +86,339 @@ def refresh_access_token():
     )
     resp.raise_for_status()
     data = resp.json()
+    # Token before deadline, so a reader that sees the new deadline also sees the new token
     access_token = data["access_token"]
-    token_obtained_ts = time.time()
-
-    # update the Connection object if it already exists
-    if 'connection' in globals():
-        connection.token = access_token
+    token_expires_at = time.monotonic() + TOKEN_LIFESPAN
         
         
 def ensure_token_valid():
-    if access_token is None or (time.time() - token_obtained_ts) > TOKEN_LIFESPAN:
-        refresh_access_token()
-    return access_token
+    # Every item comes through here; only take the lock once the token is due for renewal
+    if time.monotonic() < token_expires_at:
+        return access_token
+    with _token_lock:
+        if time.monotonic() >= token_expires_at:
+            refresh_access_token()
+        return access_token
+
+
+def renew_token(stale_token):
+    """Refresh after eBay rejected `stale_token`, unless another worker already has"""
+    with _token_lock:
+        if access_token == stale_token:
+            refresh_access_token()
+        return access_token
+
+
+# AddFixedPriceItem request; the credentials wrapper takes the current token and
+# the pre-rendered <Item>, so a token refresh never re-renders the item
+_ADD_ITEM_REQUEST = (
+    "<?xml version='1.0' encoding='utf-8'?>"
+    '<AddFixedPriceItemRequest xmlns="urn:ebay:apis:eBLBaseComponents">'
+    "<RequesterCredentials><eBayAuthToken>{token}</eBayAuthToken></RequesterCredentials>"
+    "{item}"
+    "</AddFixedPriceItemRequest>"
+)
+
+# Every $-value is already XML-escaped by the caller
+_ITEM_TEMPLATE = Template(
+    "<Item>"
+    "<Title>$title</Title>"
+    "<Description><![CDATA[$description]]></Description>"
+    "<PrimaryCategory><CategoryID>261186</CategoryID></PrimaryCategory>"
+    "<StartPrice>$start_price</StartPrice>"
+    "<CategoryMappingAllowed>true</CategoryMappingAllowed>"
+    "<Country>GB</Country>"
+    "<Currency>GBP</Currency>"
+    "<ConditionID>1000</ConditionID>"
+    "<DispatchTimeMax>1</DispatchTimeMax>"
+    "<ListingDuration>GTC</ListingDuration>"
+    "<ListingType>FixedPriceItem</ListingType>"
+    "<Quantity>$quantity</Quantity>"
+    "<Location>Port Glasgow</Location>"
+    "<PostalCode>PA14 5YU</PostalCode>"
+    "<ItemSpecifics>"
+    "<NameValueList><Name>Title</Name><Value>$title</Value></NameValueList>"
+    "<NameValueList><Name>Author</Name><Value>$author</Value></NameValueList>"
+    "<NameValueList><Name>Binding</Name><Value>$binding</Value></NameValueList>"
+    "<NameValueList><Name>Language</Name><Value>$language</Value></NameValueList>"
+    "<NameValueList><Name>ISBN</Name><Value>$isbn</Value></NameValueList>"
+    "<NameValueList><Name>Publisher</Name><Value>$publisher</Value></NameValueList>"
+    "<NameValueList><Name>Topic</Name><Value>Books</Value></NameValueList>"
+    "<NameValueList><Name>Format</Name><Value>$binding</Value></NameValueList>"
+    "$publication_year"
+    "</ItemSpecifics>"
+    "<BusinessPolicies><PaymentPolicyID>$payment_policy</PaymentPolicyID></BusinessPolicies>"
+    "<ReturnPolicy>"
+    "<ReturnsAcceptedOption>ReturnsAccepted</ReturnsAcceptedOption>"
+    "<RefundOption>MoneyBack</RefundOption>"
+    "<ReturnsWithinOption>Days_30</ReturnsWithinOption>"
+    "<ShippingCostPaidByOption>Buyer</ShippingCostPaidByOption>"
+    "</ReturnPolicy>"
+    "<ShippingDetails>"
+    "<ShippingType>Flat</ShippingType>"
+    "<ShippingServiceOptions>"
+    "<ShippingServicePriority>1</ShippingServicePriority>"
+    "<ShippingService>UK_RoyalMailTracked</ShippingService>"
+    "<FreeShipping>true</FreeShipping>"
+    "<ShippingServiceCost>0.00</ShippingServiceCost>"
+    "<ShippingServiceAdditionalCost>0.00</ShippingServiceAdditionalCost>"
+    "</ShippingServiceOptions>"
+    "<ShippingServiceOptions>"
+    "<ShippingServicePriority>2</ShippingServicePriority>"
+    "<ShippingService>UK_RoyalMailNextDay</ShippingService>"
+    "<FreeShipping>false</FreeShipping>"
+    "<ShippingServiceCost>2.95</ShippingServiceCost>"
+    "<ShippingServiceAdditionalCost>2.95</ShippingServiceAdditionalCost>"
+    "</ShippingServiceOptions>"
+    "</ShippingDetails>"
+    "<ProductListingDetails><ISBN>$isbn</ISBN></ProductListingDetails>"
+    "$picture_details"
+    "</Item>"
+)
+
+
+# Sent with every Trading API call; the OAuth calls share the session but not these
+_TRADING_HEADERS = {
+    'X-EBAY-API-COMPATIBILITY-LEVEL': '1245',
+    'X-EBAY-API-CALL-NAME': 'AddFixedPriceItem',
+    'X-EBAY-API-SITEID': '3',
+    'X-EBAY-API-APP-NAME': EBAY_CREDENTIALS['client_id'],
+    'X-EBAY-API-DEV-NAME': EBAY_CREDENTIALS['dev_id'],
+    'X-EBAY-API-CERT-NAME': EBAY_CREDENTIALS['client_secret'],
+    'Content-Type': 'text/xml'
+}
 
 
-def extract_year(date_str):
-    match = re.search(r'\b\d{4}\b', str(date_str))
-    return match.group(0) if match else None
+def create_session() -> requests.Session:
+    """
+    Pooled keep-alive session for api.ebay.com. Token refreshes and listing calls go
+    to the same host, so they reuse each other's warm connections.
+    """
+    session = requests.Session()
+    # Status retries only apply to idempotent methods, so AddFixedPriceItem is never resent
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=EBAY_MAX_WORKERS, max_retries=retries))
+    return session
 
 
-def calculate_start_price(item, final_price):
-    try:
-        vat_code = item.get('vat_code', 's').lower()
-        vat_percent = {'z': 0.0, 's': 20.0}.get(vat_code, 5.0)
-        if vat_percent < 0:
-            print(f"Invalid VAT for item {item.get('id')}")
-            return None
-        net_price = final_price * (1 + vat_percent/100)
-        return round(net_price, 2)
-    except Exception as e:
-        print(f"Price calc error for {item.get('id')}: {e}")
-        return None
+_SESSION = create_session()
 
 
-def xml_safe(text):
-    return escape(text, {"\"": "&quot;", "'": "&apos;"})
+def parse_trading_response(content: bytes):
+    """
+    Stream the response for the few fields we use: returns (Ack, ItemID, errors)
+    where errors is a list of (ErrorCode, LongMessage) pairs.
+    """
+    ack = item_id = None
+    errors = []
+    for _, elem in etree.iterparse(io.BytesIO(content), events=('end',)):
+        tag = etree.QName(elem).localname
+        if tag == 'Ack':
+            ack = elem.text
+        elif tag == 'ItemID':
+            item_id = elem.text
+        elif tag == 'Errors':
+            fields = {etree.QName(child).localname: child.text for child in elem}
+            errors.append((fields.get('ErrorCode'), fields.get('LongMessage')))
+            elem.clear()
+    return ack, item_id, errors
+
+
+def add_fixed_price_item(session: requests.Session, token: str, item_xml: str):
+    """POST one AddFixedPriceItem call; returns parse_trading_response's tuple"""
+    body = _ADD_ITEM_REQUEST.format(token=xml_safe(token), item=item_xml).encode('utf-8')
+    EBAY_RATE_LIMITER.acquire()
+    response = session.post(TRADING_API_URL, data=body, headers=_TRADING_HEADERS)
+    if response.status_code == 429:
+        # Throttled: hold every worker back for as long as eBay asks
+        retry_after = response.headers.get('Retry-After', '')
+        EBAY_RATE_LIMITER.pause(float(retry_after) if retry_after.isdigit() else 60.0)
+    response.raise_for_status()
+    return parse_trading_response(response.content)
+
+
+def is_token_error(errors) -> bool:
+    return any(
+        code in TOKEN_ERROR_CODES
+        or 'Invalid token' in (message or '') or 'token expired' in (message or '').lower()
+        for code, message in errors
+    )
 
 
-def sanitize_description(raw_description):
-    # Remove HTML <a> tags completely
-    no_html_links = re.sub(r'<a\s+[^>]href=[\'"][^\'"][\'"][^>]>(.?)</a>', r'\1 [LINK]', raw_description, flags=re.IGNORECASE)
-    
-    # Replace plain URLs (http, https, www) with [LINK]
-    no_plain_links = re.sub(r'https?://\S+|www\.\S+', '[LINK]', no_html_links, flags=re.IGNORECASE)
-    
-    return no_plain_links
+def has_column(supabase: Client, column: str) -> bool:
+    """Probe once whether the table has a column; PostgREST rejects a select of a missing one"""
+    try:
+        supabase.table(table_name).select(column).limit(1).execute()
+        return True
+    except Exception as e:
+        logger.warning(f"{table_name}.{column} is not usable ({e}); run migrate.py to add it")
+        return False
 
 
-def stock_visiblity(actual_stock):
-    if actual_stock > 50:
-        visible_quantity = 10
-    elif actual_stock < 10:
-        visible_quantity = 2
-    else:
-        visible_quantity = actual_stock
+def iter_unlisted(supabase: Client, page_size: int = INVENTORY_PAGE_SIZE, price_filter: bool = True):
+    """
+    Stream unlisted rows page by page. Rows leave the listed=False set as they are
+    listed, so pages are keyed on the last id seen rather than on a row offset.
+    With price_filter, rows whose final_price is below MIN_START_PRICE are dropped by
+    the database; list_item still applies the floor to the Python price either way.
+    """
+    last_id = None
+    while True:
+        query = supabase.table(table_name).select(LISTING_COLUMNS).eq('listed', False)
+        if price_filter:
+            # A cent of slack: Postgres and Python can round a half-penny differently,
+            # and the Python price decides
+            query = query.gte('final_price', MIN_START_PRICE - 0.01)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        rows = query.order('id').limit(page_size).execute().data
+        yield from listings_from_rows(rows)
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def list_item(session: requests.Session, item: Listing):
+    """Runs on a worker thread: build, price and submit one listing; returns its id if it was listed"""
+    try:
+        language = 'English' if item.language == 'en' else item.language
+        pub_year = item.pub_year
+        raw_title = generate_book_title(item.title, item.author, item.binding, pub_year)
+        safe_title = xml_safe(raw_title)
+
+        # Escape item specifics values
+        author_val = xml_safe(item.author.split()[-1])
+        binding_val = xml_safe(item.binding or 'Unknown')
+        isbn_val = xml_safe(str(item.isbn13 or 'Unknown'))
+        publisher_val = xml_safe(item.publisher or 'Unknown')
         
-    return visible_quantity
+        description = sanitize_description(item.description)
+        
+        stock_visible = stock_visiblity(item.stock)
 
+        start_price = calculate_start_price(item)
+        if not start_price or start_price < MIN_START_PRICE:
+            return None
 
-def get_existing_columns(supabase: Client, table_name: str) -> List[str]:
-    """Retrieve current table columns from Supabase using a row sample"""
+        item_xml = _ITEM_TEMPLATE.substitute(
+            title=safe_title,
+            description=description,
+            start_price=f"{start_price:.2f}",
+            quantity=stock_visible,
+            author=author_val,
+            binding=binding_val,
+            language=xml_safe(language or 'Unknown'),
+            isbn=isbn_val,
+            publisher=publisher_val,
+            publication_year=(
+                f"<NameValueList><Name>Publication Year</Name><Value>{xml_safe(pub_year)}</Value></NameValueList>"
+                if pub_year else ""
+            ),
+            payment_policy=xml_safe(EBAY_CREDENTIALS['business_policies']['payment'] or ''),
+            picture_details=(
+                f"<PictureDetails><PictureURL>{xml_safe(item.cover_image)}</PictureURL></PictureDetails>"
+                if item.cover_image else ""
+            )
+        )
+
+        token = ensure_token_valid()
+        ack, item_id, errors = add_fixed_price_item(session, token, item_xml)
+        if ack == 'Failure' and is_token_error(errors):
+            # token expired mid-run: refresh+retry once
+            logger.info("Access token expired mid-run, refreshing…")
+            ack, item_id, errors = add_fixed_price_item(session, renew_token(token), item_xml)
+
+        if ack in ('Success', 'Warning'):
+            logger.info(f"Successfully listed: {safe_title} (ID: {item_id})")
+            return item.id
+        logger.error(f"eBay error for {item.id}: {[message for _, message in errors]}")
+    except Exception as e:
+        logger.error(f"Error processing {item.id}: {e}")
+    return None
+
+
+def mark_listed(supabase: Client, ids: List[str]) -> List[str]:
+    """
+    Flag a batch of rows listed=TRUE in one UPDATE ... WHERE id IN (...). Returns the
+    ids still to be written: none on success, the whole batch to retry on failure.
+    """
+    if not ids:
+        return []
     try:
-        result = supabase.table(table_name).select("*").limit(1).execute()
-        if result.data and len(result.data) > 0:
-            return list(result.data[0].keys())
-        elif result.data == []:
-            # No rows, but table exists: get from 'columns' attribute
-            # Some Supabase clients return column metadata in response
-            return result.model_dump().get("columns", [])
+        supabase.table(table_name).update({'listed': True}).in_('id', ids).execute()
         return []
     except Exception as e:
-        print(f"❌ Column detection error: {e}")
-        return []
+        logger.warning(f"Failed to mark {len(ids)} listings as listed, will retry: {e}")
+        return ids
 
 
-def main():
+def setup_logging(level: str = os.getenv('LOG_LEVEL', 'INFO')) -> logging.handlers.QueueListener:
+    """
+    Route `logger` and listing_common's module logger through an unbounded queue so listing
+    workers never block on stderr; LOG_LEVEL=WARNING keeps only failures. Stop the returned
+    listener to flush it.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for routed_logger in (logger, logging.getLogger('listing_common')):
+        routed_logger.addHandler(queue_handler)
+        routed_logger.setLevel(level)
+        routed_logger.propagate = False
+    listener.start()
+    return listener
 
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    print("Connected to Supabase")
-    
-    columns = get_existing_columns(supabase, table_name)
-    print(f"🧾 Columns in {table_name}:", columns)
 
-    if "listed" in columns:
-        print("ℹ️ 'listed' column already exists.")
-    else:
-        print("➕ 'listed' column missing — adding it...")  
-    
-        sql = f"""
-        ALTER TABLE {table_name}
-        ADD COLUMN IF NOT EXISTS listed boolean
-            DEFAULT FALSE NOT NULL;
-        """
-        try:
-        # Execute via RPC
-            res = supabase.rpc('execute_sql', {'sql': sql}).execute()
-            
-            code = getattr(res, 'status_code', None)
-            if code is not None and code >= 400:
-                print(f"❌ Failed to add 'listed' column ({code}):", res.data)
-            else:
-                print("✅ 'listed' column is ensured (default FALSE).")
-        except Exception as e:
-        # catch network/validation errors
-            print("❌ RPC call failed:", e)
+def main():
 
-        
-    
-    
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    logger.info("Connected to Supabase")
     
     refresh_access_token()
-    global connection
-
-    connection = Connection(
-        debug=False,config_file=None, domain='api.ebay.com', certid=EBAY_CREDENTIALS['client_secret'],
-        appid=EBAY_CREDENTIALS['client_id'], devid=EBAY_CREDENTIALS['dev_id'], token=access_token, siteid=3
-    )
+    # Without final_price (migrate.py not run, or it failed) list unfiltered and rely on the Python floor
+    price_filter = has_column(supabase, 'final_price')
 
     success_count = 0
-    inventory = supabase.table(table_name).select('*').order('publication_year', desc=False).eq('listed', False).execute().data
-
-    for item in inventory:
-                
-        ensure_token_valid()
-        
-        try:
-            language = 'English' if item.get('language', 'en') == 'en' else item.get('language')
-            pub_year = extract_year(item.get('publication_year'))
-            raw_title = generate_book_title(item['title'], item['author'], item.get('binding'), pub_year, BINDING_SHORTCODES)
-            safe_title = xml_safe(raw_title)
-
-            # Escape item specifics values
-            author_val = xml_safe(item['author'].split()[-1])
-            binding_val = xml_safe(item.get('binding', 'Unknown'))
-            isbn_val = xml_safe(item.get('isbn13', 'Unknown'))
-            publisher_val = xml_safe(item.get('publisher', 'Unknown'))
-            
-            description = sanitize_description(item.get('description', 'No description available'))
-            
-            stock_visible = stock_visiblity(int(item['stock']))
-            
-            
-
-            payload = {
-                "Item": {
-                    "Title": safe_title,
-                    "Description": f"<![CDATA[{description}]]>",
-                    "PrimaryCategory": {"CategoryID": "261186"},
-                    "StartPrice": "9.99",
-                    "CategoryMappingAllowed": "true",
-                    "Country": "GB",
-                    "Currency": "GBP",
-                    "ConditionID": "1000",
-                    "DispatchTimeMax": "1",
-                    "ListingDuration": "GTC",
-                    "ListingType": "FixedPriceItem",
-                    "Quantity": str(stock_visible),
-                    "Location": xml_safe("Port Glasgow"),
-                    "PostalCode": xml_safe("PA14 5YU"),
-                    "ItemSpecifics": {
-                        "NameValueList": [
-                            {"Name": "Title", "Value": [safe_title]},
-                            {"Name": "Author", "Value": [author_val]},
-                            {"Name": "Binding", "Value": [binding_val]},
-                            {"Name": "Language", "Value": [xml_safe(language)]},
-                            {"Name": "ISBN", "Value": [isbn_val]},
-                            {"Name": "Publisher", "Value": [publisher_val]},
-                            {"Name": "Topic", "Value": "Books"},
-                            {"Name": "Format", "Value": [binding_val]}
-                        ]
-                    },
-                    "BusinessPolicies": {"PaymentPolicyID": EBAY_CREDENTIALS['business_policies']['payment']},
-                    "ReturnPolicy": {"ReturnsAcceptedOption": "ReturnsAccepted", "RefundOption": "MoneyBack", "ReturnsWithinOption": "Days_30", "ShippingCostPaidByOption": "Buyer"},
-                    
-                    
-                    # 'ShippingDetails': {'ShippingServiceOptions':[{'ShippingServicePriority':1,'ShippingService':'UK_RoyalMailTracked48','FreeShipping':True,'ShippingServiceCost':{'value':'0.00','currencyID':'GBP'},'ShippingServiceAdditionalCost':{'value':'0.00','currencyID':'GBP'}},{'ShippingServicePriority':2,'ShippingService':'UK_RoyalMail24','FreeShipping':False,'ShippingServiceCost':{'value':'2.95','currencyID':'GBP'},'ShippingServiceAdditionalCost':{'value':'2.95','currencyID':'GBP'}}]},
-
-                    # "ShippingDetails":{"ShippingType":"Flat","ShippingServiceOptions":[{"ShippingServicePriority":1,"ShippingService":"UK_RoyalMailTracked","FreeShipping":"true","ShippingServiceCost":{"@currencyID":"GBP","__value__":"0.0"},"ShippingServiceAdditionalCost":{"@currencyID":"GBP","__value__":"2.95"}},{"ShippingServicePriority":2,"ShippingService":"UK_RoyalMail24","FreeShipping":"false","ShippingServiceCost":{"@currencyID":"GBP","__value__":"2.95"}, "ShippingServiceAdditionalCost":{"@currencyID":"GBP","__value__":"2.95"}}]},
-                    
-                    
-                    "ShippingDetails":{"ShippingType":"Flat","ShippingServiceOptions":[{"ShippingServicePriority":1,"ShippingService":"UK_RoyalMailTracked","FreeShipping":"true","ShippingServiceCost":"0.00","ShippingServiceAdditionalCost":"0.00"},{"ShippingServicePriority":2,"ShippingService":"UK_RoyalMailNextDay","FreeShipping":"false","ShippingServiceCost":"2.95", "ShippingServiceAdditionalCost":"2.95"}]},
-
-
-                    
-                    
-                    # "ShippingDetails": {"ShippingServiceOptions": [{"ShippingServicePriority": "1", "ShippingService": "UK_RoyalMailSecondClassStandard", "ShippingServiceCost": "3.00", "FreeShipping": "false", "ShippingServiceAdditionalCost": "0.00"},{'ShippingServicePriority': '2', 'ShippingService': 'UK_RoyalMail24', 'ShippingServiceCost': '2.95', 'FreeShipping': 'false', 'ShippingServiceAdditionalCost': '2.95'}]},
-                    
-                    # 'ShippingDetails': {'ShippingServiceOptions': [{'ShippingServicePriority': '1', 'ShippingService': 'UK_RoyalMailTracked48', 'ShippingServiceCost': '0.00', 'FreeShipping': 'true', 'ShippingServiceAdditionalCost': '0.00'}, {'ShippingServicePriority': '2', 'ShippingService': 'UK_RoyalMail24', 'ShippingServiceCost': '2.95', 'FreeShipping': 'false', 'ShippingServiceAdditionalCost': '2.95'}]},
-                  
-                    "ProductListingDetails": {"ISBN": isbn_val}
-                }
-            }
-
-            if pub_year:
-                payload["Item"]["ItemSpecifics"]["NameValueList"].append({"Name": "Publication Year", "Value": [xml_safe(pub_year)]})
-            if item.get('cover_image'):
-                payload["Item"]["PictureDetails"] = {"PictureURL": [item['cover_image']]}  # URLs are safe
-
-            vat_excl = inclusive_price(item)
-            start_price = calculate_start_price(item, vat_excl)
-            if not start_price or start_price < 0.99:
-                continue
-            payload["Item"]["StartPrice"] = f"{start_price:.2f}"
-
-            response = connection.execute('AddFixedPriceItem', payload)
-            if response.dict().get('Ack') in ('Success','Warning'):
-                supabase.table(table_name).update({'listed': True}).eq('id', item['id']).execute()
-                print(f"Successfully listed: {safe_title} (ID: {response.dict()['ItemID']})")
-                success_count += 1
-                print("Total successful listings:", success_count)
-        except ConnectionError as e:
-            # if it’s a token-expired error, refresh+retry once
-            if 'Invalid token' in str(e) or 'token expired' in str(e).lower():
-                print("Access token expired mid-run, refreshing…")
-                refresh_access_token()
-                response = connection.execute('AddFixedPriceItem', payload)
-                if response.dict().get('Ack') in ('Success','Warning'):
-                    supabase.table(table_name).update({'listed': True})\
-                        .eq('id', item['id']).execute()
-                    print(f"✅ Listed after refresh: {item['id']}")
-            else:
-                # some other eBay error
-                print(f"eBay error for {item['id']}: {e}")
-        except Exception as e:
-            print(f"Error processing {item['id']}: {e}")
+    unsaved_ids = []
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=EBAY_MAX_WORKERS) as executor:
+            # The next page is fetched while the current one is being listed
+            for item in prefetch(iter_unlisted(supabase, price_filter=price_filter), INVENTORY_PAGE_SIZE):
+                # Keep a bounded number of listings in flight while the inventory streams in
+                if len(pending) >= EBAY_MAX_WORKERS * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    new_ids = [listed_id for listed_id in (future.result() for future in done) if listed_id is not None]
+                    success_count += len(new_ids)
+                    unsaved_ids.extend(new_ids)
+                    if len(unsaved_ids) >= LISTED_BATCH_SIZE:
+                        unsaved_ids = mark_listed(supabase, unsaved_ids)
+                pending.add(executor.submit(list_item, _SESSION, item))
+
+            new_ids = [listed_id for listed_id in (future.result() for future in as_completed(pending)) if listed_id is not None]
+            success_count += len(new_ids)
+            unsaved_ids.extend(new_ids)
+    except Exception:
+        # The schema is set up by migrate.py, not checked on every run
+        logger.error(f"Listing run failed; if {table_name} lacks the listed column, run migrate.py")
+        raise
+    finally:
+        # Flush the last partial batch even if the run stops early, so those rows are not relisted
+        unsaved_ids = mark_listed(supabase, unsaved_ids)
+        if unsaved_ids:
+            logger.error(f"⚠️ Listed on eBay but not flagged in Supabase: {unsaved_ids}")
+
+    logger.info(f"Total successful listings: {success_count}")
 
 
 if __name__ == "__main__":
     if RUN_SCRIPT.lower() == "yes":
-        main()
+        log_listener = setup_logging()
+        try:
+            main()
+        finally:
+            log_listener.stop()
     else:
         print("Script execution skipped because RUN_SCRIPT is not 'yes'.")
\ No newline at end of file
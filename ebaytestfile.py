@@ -2,13 +2,14 @@ import requests
 import urllib.parse
 import base64
 import re
-import time
 from supabase import create_client, Client
 from ebaysdk.trading import Connection
 from ebaysdk.exception import ConnectionError
 from ebaysdk.utils import dict2xml
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_SHORTCODES
+from calculate_price import REDUCED_VAT_MULTIPLIER, VAT_MULTIPLIERS, inclusive_price
+from rate_limiter import TokenBucket
 
 # Configuration
 table_name = os.getenv('SUPABASE_TABLE_NAME')
@@ -26,68 +27,12 @@ EBAY_CREDENTIALS = {
     }
 }
 
-BINDING_SHORTCODES = {
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
-}
+# Caps calls at one per second without sleeping when the last call already took that long
+EBAY_RATE_LIMITER = TokenBucket(1)
+
+# Compiled once at import rather than looked up in the re cache for every item
+_YEAR_RE = re.compile(r'\b\d{4}\b')
+
 
 def generate_book_title(book_name, author, binding_type=None, publication_year=None, binding_codes=None):
     binding_codes = binding_codes or {}
@@ -102,50 +47,31 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
             binding_abbr = 'HC'
         else:
             binding_abbr = binding_codes.get(binding_type, binding_type)
-    components = {
-        'book': book_name,
-        'by': "by",
-        'author': author,
-        'binding': binding_abbr,
-        'year': publication_year
-    }
-    variations = []
-    variations.append(f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip())
-    variations.append(f"{book_name} by {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    variations.append(f"{book_name} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    base_length = len(f"{book_name} ") + len(f" {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
-    max_author_len = 65 - base_length - 1
-    if max_author_len >= 1:
-        truncated_author = truncate(author, max_author_len)
-        variations.append(f"{book_name} {truncated_author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    base_length = len(f" {author} {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
-    max_book_len = 65 - base_length - 1
-    if max_book_len >= 1:
-        truncated_book = truncate(book_name, max_book_len)
-        variations.append(f"{truncated_book} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    for title in variations:
+    def candidates():
+        # Built one at a time, so the loop below stops formatting at the first that fits
+        yield f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip()
+        suffix = f"{binding_abbr or ''} Book {publication_year or ''}"
+        yield f"{book_name} by {author} {suffix}".strip()
+        yield f"{book_name} {author} {suffix}".strip()
+        max_author_len = 65 - (len(book_name) + 1 + len(suffix.strip()) + 1) - 1
+        if max_author_len >= 1:
+            yield f"{book_name} {truncate(author, max_author_len)} {suffix}".strip()
+        max_book_len = 65 - (len(f"{author} {suffix}".strip()) + 1) - 1
+        if max_book_len >= 1:
+            yield f"{truncate(book_name, max_book_len)} {author} {suffix}".strip()
+    for title in candidates():
         if len(title) <= 65:
-            return title[:65]
+            return title
     return truncate(book_name, 62).ljust(65, ellipsis)[:65]
 
 def extract_year(date_str):
-    match = re.search(r'\b\d{4}\b', str(date_str))
+    match = _YEAR_RE.search(str(date_str))
     return match.group(0) if match else None
 
 def calculate_start_price(item , final_price):
     try:
-        vat_percent = (item['vat_code']).lower()
-        if vat_percent == 'z':
-            vat_percent = float(0.0)
-        elif vat_percent == 's':
-            vat_percent = float(20.0)
-        else:
-            vat_percent = float(5.0)
-        if any(val < 0 for val in [vat_percent]):
-            print(f"Invalid negative value in pricing data for item {item.get('id')}")
-            return None
-        net_price = final_price * (1 + (vat_percent / 100))
-        return round(net_price, 2)
+        multiplier = VAT_MULTIPLIERS.get(item['vat_code'].lower(), REDUCED_VAT_MULTIPLIER)
+        return round(final_price * multiplier, 2)
     except KeyError as e:
         print(f"Missing required pricing field {e} for item {item.get('id')}")
         return None
@@ -283,15 +209,16 @@ def main():
                 continue
             print(f"Submitting payload for item {item.get('id')}:\n{payload}")
             try:
+                EBAY_RATE_LIMITER.acquire()
                 response = connection.execute('AddFixedPriceItem', payload)
                 success_count += 1
-                if response.dict()['Ack'] == 'Warning':
-                    print(f"Successfully listed: {title} (ID: {response.dict()['ItemID']})")
+                reply = response.dict()
+                if reply['Ack'] == 'Warning':
+                    print(f"Successfully listed: {title} (ID: {reply['ItemID']})")
                 else:
-                    print(f"Error listing {title}: {response.dict().get('Errors', 'Unknown error')}")
+                    print(f"Error listing {title}: {reply.get('Errors', 'Unknown error')}")
             except Exception as api_e:
                 print(f"eBay API error for item {item.get('id')}: {str(api_e)}")
-            time.sleep(1)
         except Exception as e:
             print(f"Failed to process item {item.get('id')}: {str(e)}")
             continue
@@ -2,6 +2,8 @@ import os
 import base64
 import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ─── Configuration ────────────────────────────────────────────────────────────
 CLIENT_ID        = os.getenv("EBAY_CLIENT_ID")
@@ -27,6 +29,17 @@ LOCATION_PAYLOAD = {
     
 }
 
+# Client credentials never change during a run, so the Basic auth header is built once
+_BASIC_AUTH = "Basic " + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+
+# One keep-alive session, so the token exchange and location calls share a TLS connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
 # ─── Step 1: Get User Authorization Code ───────────────────────────────────────
 def print_authorization_url():
     qs = {
@@ -44,17 +57,16 @@ def print_authorization_url():
 # ─── Step 2: Exchange Code for User Access Token ──────────────────────────────
 def get_user_token(redirected_url: str) -> str:
     code = urllib.parse.parse_qs(urllib.parse.urlparse(redirected_url).query)["code"][0]
-    auth = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
-        "Authorization": f"Basic {auth}"
+        "Authorization": _BASIC_AUTH
     }
     data = {
         "grant_type":   "authorization_code",
         "code":         code,
         "redirect_uri": REDIRECT_URI
     }
-    resp = requests.post("https://api.ebay.com/identity/v1/oauth2/token",
+    resp = _SESSION.post("https://api.ebay.com/identity/v1/oauth2/token",
                          headers=headers, data=data)
     resp.raise_for_status()
     return resp.json()["access_token"]
@@ -66,7 +78,7 @@ def create_location(token: str):
         "Authorization": f"Bearer {token}",
         "Content-Type":  "application/json"
     }
-    resp = requests.post(url, headers=headers, json=LOCATION_PAYLOAD)
+    resp = _SESSION.post(url, headers=headers, json=LOCATION_PAYLOAD)
     if resp.status_code == 204:
         print(f"✅ Location `{LOCATION_KEY}` created.")
     else:
@@ -77,7 +89,7 @@ def create_location(token: str):
 def get_location(token: str):
     url     = f"{API_BASE}/location/{LOCATION_KEY}"
     headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(url, headers=headers)
+    resp = _SESSION.get(url, headers=headers)
     resp.raise_for_status()
     data = resp.json()
     print("\n🔍 Retrieved location data:\n")
@@ -20,6 +20,10 @@ EBAY_CREDENTIALS = {
     }
 }
 
+# Client credentials never change during a run, so the Basic auth header is built once
+_BASIC_AUTH = "Basic " + base64.b64encode(
+    f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode()
+).decode()
 
 auth_url = (
         f"https://auth.ebay.com/oauth2/authorize?client_id={EBAY_CREDENTIALS['client_id']}"
@@ -34,9 +38,7 @@ token_response = requests.post(
     "https://api.ebay.com/identity/v1/oauth2/token",
     headers={
         "Content-Type": "application/x-www-form-urlencoded",
-        "Authorization": "Basic " + base64.b64encode(
-            f"{EBAY_CREDENTIALS['client_id']}:{EBAY_CREDENTIALS['client_secret']}".encode()
-        ).decode()
+        "Authorization": _BASIC_AUTH
     },
     data={"grant_type": "authorization_code", "code": code, "redirect_uri": EBAY_CREDENTIALS['redirect_uri']}
 )
@@ -1,11 +1,20 @@
+import asyncio
+import hashlib
 import requests
 import urllib.parse
 import base64
 import re
-import time
+import orjson
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import aiohttp
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying, retry, retry_if_exception, stop_after_attempt, wait_exponential
 from supabase import create_client, Client
 import os
-from calculate_price import inclusive_price
+from binding_codes import BINDING_SHORTCODES
+from calculate_price import cached_start_price
+from listing_common import LISTING_COLUMNS
 
 # Configuration (unchanged)
 table_name = os.getenv('SUPABASE_TABLE_NAME')
@@ -24,69 +33,39 @@ EBAY_CREDENTIALS = {
     }
 }
 
-# Binding Type Short Codes (unchanged)
-BINDING_SHORTCODES = {
-    'Album': 'ALB',
-    'Audio Cassette': 'ACS',
-    'Audio CD': 'ACD',
-    'Bath Book': 'BTH',
-    'Blu-ray': 'BRY',
-    'Board book': 'BBK',
-    'board_book': 'BBK',
-    'Bonded Leather': 'BLE',
-    'Calendar': 'CAL',
-    'Card Book': 'CRB',
-    'Cards': 'CRD',
-    'CD-ROM': 'CDR',
-    'Diary': 'DIR',
-    'DVD': 'DVD',
-    'DVD Audio': 'DVA',
-    'DVD-ROM': 'DVR',
-    'Flexibound': 'FB',
-    'Game': 'GAM',
-    'Hardcover': 'HC',
-    'Hardcover-spiral': 'HCS',
-    'Imitation Leather': 'IML',
-    'JP Oversized': 'JPO',
-    'Kindle Edition': 'KIN',
-    'Kindle Edition with Audio/Video': 'KAV',
-    'Kitchen': 'KIT',
-    'Leather Bound': 'LB',
-    'Library Binding': 'LIB',
-    'Loose Leaf': 'LSL',
-    'Map': 'MAP',
-    'Mass Market Paperback': 'MMP',
-    'mass_market': 'MMP',
-    'Misc.': 'MSC',
-    'Misc. Supplies': 'MSC',
-    'Notebook': 'NTB',
-    'Novelty Book': 'NOV',
-    'Office Product': 'OFP',
-    'Pamphlet': 'PAM',
-    'Paperback': 'PB',
-    'Paperback Bunko': 'PBU',
-    'Perfect Paperback': 'PPB',
-    'Pocket Book': 'PKB',
-    'Poster': 'POS',
-    'print': 'PRT',
-    'Print on Demand (Paperback)': 'POD',
-    'Printed Access Code': 'PAC',
-    'Product Bundle': 'PRB',
-    'Rag Book': 'RGB',
-    'Ring-bound': 'RNG',
-    'School & Library Binding': 'SLB',
-    'Sheet music': 'STM',
-    'Spiral-bound': 'SPI',
-    'Sports': 'SPT',
-    'Staple Bound': 'STB',
-    'Stationery': 'STN',
-    'Textbook Binding': 'TXB',
-    'Toy': 'TOY',
-    'Unbound': 'UBD',
-    'Unknown Binding': 'UNK',
-    'VHS Tape': 'VHS',
-    'Wall Chart': 'WCH'
+# The parts of each payload that are the same for every item; per-item fields are merged on top
+_INVENTORY_ITEM_TEMPLATE = {
+    "condition": "NEW",
+    "locale": "en_GB"
 }
+_OFFER_TEMPLATE = {
+    "marketplaceId": "EBAY_GB",
+    "format": "FIXED_PRICE",
+    "categoryId": "268",
+    "listingPolicies": {
+        "paymentPolicyId": EBAY_CREDENTIALS['business_policies']['payment'],
+        "returnPolicyId": EBAY_CREDENTIALS['business_policies']['return'],
+        "fulfillmentPolicyId": EBAY_CREDENTIALS['business_policies']['shipping']
+    },
+    "merchantLocationKey": EBAY_CREDENTIALS['merchant_location_key']
+}
+_OFFER_IDENTITY_FIELDS = {"sku", "marketplaceId", "format"}
+
+INVENTORY_API_URL = "https://api.ebay.com/sell/inventory/v1"
+INVENTORY_PAGE_SIZE = 1000
+# Hash of the last inventory payload sent per SKU, so re-runs skip unchanged PUTs
+ETAG_CACHE_PATH = Path('.inventory_etags.json')
+MAX_CONCURRENT_ITEMS = 64
+MAX_CONNECTIONS_PER_HOST = 8
+# Per-endpoint limiters shared by every in-flight item: inventory and offer writes
+# have a far larger quota than publishing, so they are allowed to burst ahead
+INVENTORY_LIMITER = AsyncLimiter(20, 1)
+PUBLISH_LIMITER = AsyncLimiter(5, 1)
+_resume_at = {INVENTORY_LIMITER: 0.0, PUBLISH_LIMITER: 0.0}
+_inventory_etags: Dict[str, str] = {}
+
+# Compiled once at import rather than looked up in the re cache for every item
+_YEAR_RE = re.compile(r'\b\d{4}\b')
 
 # Existing functions (unchanged)
 def generate_book_title(book_name, author, binding_type=None, publication_year=None, binding_codes=None):
@@ -105,57 +84,42 @@ def generate_book_title(book_name, author, binding_type=None, publication_year=N
         else:
             binding_abbr = binding_codes.get(binding_type, binding_type)
 
-    components = {
-        'book': book_name,
-        'by': "by",
-        'author': author,
-        'binding': binding_abbr,
-        'year': publication_year
-    }
+    # Variations are tried in order and built only until one fits
+    title = f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip()
+    if len(title) <= 65:
+        return title
+    suffix = f"{binding_abbr or ''} Book {publication_year or ''}"
+    title = f"{book_name} by {author} {suffix}".strip()
+    if len(title) <= 65:
+        return title
+    title = f"{book_name} {author} {suffix}".strip()
+    if len(title) <= 65:
+        return title
 
-    variations = []
-    variations.append(f"{book_name} by {author} {binding_type or ''} Book {publication_year or ''}".strip())
-    variations.append(f"{book_name} by {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    variations.append(f"{book_name} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
-    base_length = len(f"{book_name} ") + len(f" {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
+    base_length = len(book_name) + 1 + len(suffix.strip()) + 1
     max_author_len = 65 - base_length - 1
     if max_author_len >= 1:
-        truncated_author = truncate(author, max_author_len)
-        variations.append(f"{book_name} {truncated_author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
-    base_length = len(f" {author} {binding_abbr or ''} Book {publication_year or ''}".strip()) + 1
+        title = f"{book_name} {truncate(author, max_author_len)} {suffix}".strip()
+        if len(title) <= 65:
+            return title
+
+    base_length = len(f"{author} {suffix}".strip()) + 1
     max_book_len = 65 - base_length - 1
     if max_book_len >= 1:
-        truncated_book = truncate(book_name, max_book_len)
-        variations.append(f"{truncated_book} {author} {binding_abbr or ''} Book {publication_year or ''}".strip())
-    
-    for title in variations:
+        title = f"{truncate(book_name, max_book_len)} {author} {suffix}".strip()
         if len(title) <= 65:
-            return title[:65]
-    
+            return title
+
     return truncate(book_name, 62).ljust(65, ellipsis)[:65]
 
 def extract_year(date_str):
-    match = re.search(r'\b\d{4}\b', str(date_str))
+    match = _YEAR_RE.search(str(date_str))
     return match.group(0) if match else None
 
-def calculate_start_price(item, final_price):
+def calculate_start_price(item):
     try:
-        vat_percent = (item['vat_code']).lower()
-        if vat_percent == 'z':
-            vat_percent = float(0.0)
-        elif vat_percent == 's':
-            vat_percent = float(20.0)
-        else:
-            vat_percent = float(5.0)
-
-        if any(val < 0 for val in [vat_percent]):
-            print(f"Invalid negative value in pricing data for item {item.get('id')}")
-            return None
-
-        net_price = final_price * (1 + (vat_percent / 100))
-        return round(net_price, 2)
+        # Memoized on the raw pricing columns, so items sharing them are priced once
+        return cached_start_price(item.get('rrp', 0), item.get('discount', 0), item.get('weight', 0), item['vat_code'])
     
     except KeyError as e:
         print(f"Missing required pricing field {e} for item {item.get('id')}")
@@ -164,6 +128,263 @@ def calculate_start_price(item, final_price):
         print(f"Invalid pricing data for item {item.get('id')}: {str(e)}")
         return None
 
+def _pause(limiter: AsyncLimiter, seconds: float) -> None:
+    """Hold back every pending request on this limiter for the given number of seconds"""
+    _resume_at[limiter] = max(_resume_at[limiter], asyncio.get_running_loop().time() + seconds)
+
+async def _wait_for(limiter: AsyncLimiter) -> None:
+    await asyncio.sleep(max(0.0, _resume_at[limiter] - asyncio.get_running_loop().time()))
+
+def _check_rate_headers(limiter: AsyncLimiter, response: aiohttp.ClientResponse) -> None:
+    """Back the limiter off when eBay says the quota is spent instead of running into more 429s"""
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        _pause(limiter, 1)
+    if response.status == 429:
+        retry_after = response.headers.get('Retry-After', '')
+        _pause(limiter, float(retry_after) if retry_after.isdigit() else 60.0)
+
+def _is_transient(exc: BaseException) -> bool:
+    """Retry throttling, server errors and dropped connections; other 4xx fail straight away"""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+def _raise_if_transient(response: aiohttp.ClientResponse) -> None:
+    if response.status == 429 or response.status >= 500:
+        response.raise_for_status()
+
+def _is_throttled(exc: BaseException) -> bool:
+    """A 429 means eBay turned the request away unprocessed, so even a POST is safe to resend"""
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status == 429
+
+_retry_transient = retry(stop=stop_after_attempt(5),
+                         wait=wait_exponential(multiplier=1, min=2, max=30),
+                         retry=retry_if_exception(_is_transient),
+                         reraise=True)
+# createOffer and publishOffer are not idempotent: a 5xx or timeout may arrive after eBay
+# committed the request, and resending it would duplicate the offer or the listing
+_THROTTLE_RETRY_ARGS = dict(stop=stop_after_attempt(5),
+                            wait=wait_exponential(multiplier=1, min=2, max=30),
+                            retry=retry_if_exception(_is_throttled),
+                            reraise=True)
+_retry_throttled = retry(**_THROTTLE_RETRY_ARGS)
+
+@_retry_transient
+async def put_inventory(session: aiohttp.ClientSession, sku: str, payload: Dict) -> bool:
+    """Create or replace the inventory item for a SKU"""
+    await _wait_for(INVENTORY_LIMITER)
+    async with INVENTORY_LIMITER, session.put(f"{INVENTORY_API_URL}/inventory_item/{sku}", data=orjson.dumps(payload)) as response:
+        _check_rate_headers(INVENTORY_LIMITER, response)
+        _raise_if_transient(response)
+        if response.status != 204:
+            print(f"Error creating inventory item for {sku}: {await response.text()}")
+            return False
+        return True
+
+@_retry_transient
+async def get_offer(session: aiohttp.ClientSession, sku: str) -> Optional[Dict]:
+    """Return the SKU's existing EBAY_GB offer, or None when it has none"""
+    await _wait_for(INVENTORY_LIMITER)
+    async with INVENTORY_LIMITER, session.get(f"{INVENTORY_API_URL}/offer",
+                                              params={"sku": sku, "marketplace_id": "EBAY_GB"}) as response:
+        _check_rate_headers(INVENTORY_LIMITER, response)
+        _raise_if_transient(response)
+        if response.status == 404:
+            # eBay answers 404 when the SKU has no offers yet
+            return None
+        # Anything else (401, 400, ...) is not "no offer": fail the item rather than create a duplicate
+        response.raise_for_status()
+        offers = orjson.loads(await response.read()).get('offers', [])
+        return offers[0] if offers else None
+
+@_retry_transient
+async def update_offer(session: aiohttp.ClientSession, sku: str, offer_id: str, payload: Dict) -> bool:
+    """Replace an unpublished offer's details, so it is published at the current price and quantity"""
+    # updateOffer takes the offer details without the fields that identify it
+    details = {key: value for key, value in payload.items() if key not in _OFFER_IDENTITY_FIELDS}
+    await _wait_for(INVENTORY_LIMITER)
+    async with INVENTORY_LIMITER, session.put(f"{INVENTORY_API_URL}/offer/{offer_id}",
+                                              data=orjson.dumps(details)) as response:
+        _check_rate_headers(INVENTORY_LIMITER, response)
+        _raise_if_transient(response)
+        if response.status not in (200, 204):
+            print(f"Error updating offer {offer_id} for {sku}: {await response.text()}")
+            return False
+        return True
+
+async def create_offer(session: aiohttp.ClientSession, sku: str, payload: Dict) -> Optional[str]:
+    """
+    Create an unpublished offer for a SKU and return its offer id. Only a 429 is retried,
+    and each retry first checks whether the SKU has an offer after all before posting again
+    """
+    async for attempt in AsyncRetrying(**_THROTTLE_RETRY_ARGS):
+        with attempt:
+            if attempt.retry_state.attempt_number > 1:
+                offer = await get_offer(session, sku)
+                if offer:
+                    return offer['offerId']
+            return await _post_offer(session, sku, payload)
+
+async def _post_offer(session: aiohttp.ClientSession, sku: str, payload: Dict) -> Optional[str]:
+    await _wait_for(INVENTORY_LIMITER)
+    async with INVENTORY_LIMITER, session.post(f"{INVENTORY_API_URL}/offer", data=orjson.dumps(payload)) as response:
+        _check_rate_headers(INVENTORY_LIMITER, response)
+        _raise_if_transient(response)
+        if response.status != 201:
+            print(f"Error creating offer for {sku}: {await response.text()}")
+            return None
+        return (await response.json())['offerId']
+
+@_retry_throttled
+async def publish_offer(session: aiohttp.ClientSession, sku: str, offer_id: str) -> Optional[str]:
+    """Publish an offer and return the eBay listing id"""
+    await _wait_for(PUBLISH_LIMITER)
+    async with PUBLISH_LIMITER, session.post(f"{INVENTORY_API_URL}/offer/{offer_id}/publish") as response:
+        _check_rate_headers(PUBLISH_LIMITER, response)
+        _raise_if_transient(response)
+        if response.status != 200:
+            print(f"Error publishing offer for {sku}: {await response.text()}")
+            return None
+        return (await response.json())['listingId']
+
+async def process_item(session: aiohttp.ClientSession, item) -> bool:
+    """PUT inventory, POST offer and publish it for one item; the three calls stay in order per SKU"""
+    try:
+        language = item.get('language', 'en')
+        if language == 'en':
+            language = 'English'
+
+        binding = item.get('binding', 'unknown')
+        pub_year = extract_year(item.get('publication_year'))
+        title = generate_book_title(
+            item['title'],
+            item['author'], binding,
+            pub_year, BINDING_SHORTCODES
+        )
+
+        sku = item['isbn13']
+        # stock is a TEXT column; a value that is not a whole number fails just this item
+        stock = int(item['stock'])
+        inventory_item_payload = _INVENTORY_ITEM_TEMPLATE | {
+            "sku": sku,
+            "product": {
+                "title": title,  # Ensure you have a valid title
+                "description": item.get('description', 'No description available'),
+                "imageUrls": [item['cover_image']] if item.get('cover_image') else [],
+                "aspects": {
+                    "Author": [item.get('author', 'Unknown Author')],
+                    "Binding": [item.get('binding', 'Unknown Binding')],
+                    "Language": [item.get('language', 'English')],
+                    "Publication Year": [item['publication_year']],
+                    "Publisher": [item.get('publisher', 'Unknown Publisher')],
+                    "ISBN": [item['isbn13']]
+                }
+            },
+            "availability": {
+                "shipToLocationAvailability": {
+                    "quantity": stock
+                }
+            }
+        }
+
+        # Create or update inventory item, unless an earlier run already sent this exact payload
+        etag = hashlib.md5(orjson.dumps(inventory_item_payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        if _inventory_etags.get(sku) != etag:
+            if not await put_inventory(session, sku, inventory_item_payload):
+                return False
+            _inventory_etags[sku] = etag
+        print("Success Listed")
+        calculated_price = calculate_start_price(item)
+        if not calculated_price or calculated_price < 0.99:
+            print(f"Skipping item {item.get('id')} - invalid price calculation")
+            return False
+
+        offer_payload = _OFFER_TEMPLATE | {
+            "sku": sku,
+            "availableQuantity": stock,
+            "pricingSummary": {
+                "price": {
+                    "value": f"{calculated_price:.2f}",
+                    "currency": "GBP"
+                }
+            }
+        }
+
+        # Reuse the offer a previous run left behind; a published one means nothing is left to do
+        offer = await get_offer(session, sku)
+        if offer and offer.get('status') == 'PUBLISHED':
+            print(f"Already listed: {sku} (Listing ID: {offer.get('listing', {}).get('listingId')})")
+            return False
+
+        if offer:
+            # Bring the leftover offer up to date before publishing it
+            offer_id = offer['offerId']
+            if not await update_offer(session, sku, offer_id, offer_payload):
+                return False
+        else:
+            # Create offer
+            offer_id = await create_offer(session, sku, offer_payload)
+            if not offer_id:
+                return False
+
+        # Publish offer
+        listing_id = await publish_offer(session, sku, offer_id)
+        if not listing_id:
+            return False
+        print(f"Successfully listed: {item['title']} (Listing ID: {listing_id})")
+        return True
+
+    except Exception as e:
+        print(f"Failed to process item {item.get('id')}: {str(e)}")
+        return False
+
+def _load_etag_cache() -> Dict[str, str]:
+    try:
+        return orjson.loads(ETAG_CACHE_PATH.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+def iter_inventory_pages(supabase, page_size=INVENTORY_PAGE_SIZE):
+    """Yield the inventory a page at a time, fetching only the columns process_item reads"""
+    start = 0
+    while True:
+        rows = (supabase.table(table_name).select(LISTING_COLUMNS)
+                .order('id')
+                .range(start, start + page_size - 1)
+                .execute().data)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+async def _process_inventory(pages, headers) -> Tuple[int, int]:
+    """Run process_item over every inventory page on one pooled keep-alive session; returns (listed, total)"""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_ITEMS)
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST, keepalive_timeout=30)
+    listed = total = 0
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+
+        async def run(item) -> None:
+            nonlocal listed
+            try:
+                if await process_item(session, item):
+                    listed += 1
+            finally:
+                sem.release()
+
+        tasks = set()
+        # The next page is fetched in a thread while the items already started keep running
+        while (page := await asyncio.to_thread(next, pages, None)) is not None:
+            for item in page:
+                await sem.acquire()
+                task = asyncio.create_task(run(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                total += 1
+        await asyncio.gather(*tasks)
+    return listed, total
+
 def main():
     # Initialize Supabase
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
@@ -197,105 +418,12 @@ def main():
         "Content-Language": "en-US"
     }
 
-    success_count = 0
-    inventory = supabase.table(table_name).select('*').execute().data
-    for item in inventory:
-        try:
-            language = item.get('language', 'en')
-            if language == 'en':
-                language = 'English'
-
-            binding = item.get('binding', 'unknown')
-            pub_year = extract_year(item.get('publication_year'))
-            title = generate_book_title(
-                item['title'],
-                item['author'], binding,
-                pub_year, BINDING_SHORTCODES
-            )
-
-            sku = item['isbn13']
-            inventory_item_payload = {
-            "sku": sku,
-            "condition": "NEW",
-            "locale": "en_GB",
-            "product": {
-                "title": title,  # Ensure you have a valid title
-                "description": item.get('description', 'No description available'),
-                "imageUrls": [item['cover_image']] if item.get('cover_image') else [],
-                "aspects": {
-                    "Author": [item.get('author', 'Unknown Author')],
-                    "Binding": [item.get('binding', 'Unknown Binding')],
-                    "Language": [item.get('language', 'English')],
-                    "Publication Year": [item['publication_year']],
-                    "Publisher": [item.get('publisher', 'Unknown Publisher')],
-                    "ISBN": [item['isbn13']]
-                }
-            },
-            "availability": {
-                "shipToLocationAvailability": {
-                    "quantity": item['stock']
-                }
-            }
-        }
-
-            # Create or update inventory item
-            inventory_url = f"https://api.ebay.com/sell/inventory/v1/inventory_item/{sku}"
-            response = requests.put(inventory_url, headers=headers, json=inventory_item_payload)
-            
-            if response.status_code != 204:
-                print(f"Error creating inventory item for {sku}: {response.text}")
-                continue
-            print("Success Listed")
-            calculated_price_vat_exclusive = inclusive_price(item)
-            calculated_price = calculate_start_price(item, calculated_price_vat_exclusive)
-            if not calculated_price or calculated_price < 0.99:
-                print(f"Skipping item {item.get('id')} - invalid price calculation")
-                continue
-
-            offer_payload = {
-                "sku": sku,
-                "marketplaceId": "EBAY_GB",
-                "format": "FIXED_PRICE",
-                "availableQuantity": item['stock'],
-                "categoryId": "268",
-                "listingPolicies": {
-                    "paymentPolicyId": EBAY_CREDENTIALS['business_policies']['payment'],
-                    "returnPolicyId": EBAY_CREDENTIALS['business_policies']['return'],
-                    "fulfillmentPolicyId": EBAY_CREDENTIALS['business_policies']['shipping']
-                },
-                "pricingSummary": {
-                    "price": {
-                        "value": f"{calculated_price:.2f}",
-                        "currency": "GBP"
-                    }
-                },
-                "merchantLocationKey": EBAY_CREDENTIALS['merchant_location_key']
-            }
-
-            # Create offer
-            offer_url = "https://api.ebay.com/sell/inventory/v1/offer"
-            response = requests.post(offer_url, headers=headers, json=offer_payload)
-            if response.status_code == 201:
-                offer_id = response.json()['offerId']
-            else:
-                print(f"Error creating offer for {sku}: {response.text}")
-                continue
-
-            # Publish offer
-            publish_url = f"https://api.ebay.com/sell/inventory/v1/offer/{offer_id}/publish"
-            response = requests.post(publish_url, headers=headers)
-            if response.status_code == 200:
-                listing_id = response.json()['listingId']
-                print(f"Successfully listed: {item['title']} (Listing ID: {listing_id})")
-                success_count += 1
-            else:
-                print(f"Error publishing offer for {sku}: {response.text}")
-
-            time.sleep(1)  # Rate limit
-
-        except Exception as e:
-            print(f"Failed to process item {item.get('id')}: {str(e)}")
-            continue
+    _inventory_etags.update(_load_etag_cache())
+    try:
+        listed, total = asyncio.run(_process_inventory(iter_inventory_pages(supabase), headers))
+    finally:
+        ETAG_CACHE_PATH.write_bytes(orjson.dumps(_inventory_etags))
+    print(f"Listed {listed}/{total} items")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,185 @@
+import functools
+import logging
+import re
+from dataclasses import dataclass, field, fields
+from typing import List, Optional
+
+from binding_codes import BINDING_WITH_DEFAULTS
+from calculate_price import cached_start_price
+
+logger = logging.getLogger(__name__)
+
+# Compiled once at import; these run for every item in the listing loop
+_YEAR_RE = re.compile(r'\b\d{4}\b')
+_HTML_A_RE = re.compile(r'<a\s+[^>]*href=[\'"][^\'"]*[\'"][^>]*>(.*?)</a>', re.IGNORECASE | re.DOTALL)
+_URL_RE = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+
+# One pass over the string instead of a str.replace per entity
+_XML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&apos;'})
+
+
+@dataclass(slots=True)
+class Listing:
+    """
+    One inventory row, materialized once as it is streamed from Supabase. Defaults
+    apply only when the column is missing from the row, as with dict.get.
+    """
+    id: str
+    title: str
+    author: str
+    binding: Optional[str] = None
+    publication_year: Optional[str] = None
+    isbn13: Optional[str] = None
+    publisher: Optional[str] = 'Unknown'
+    cover_image: Optional[str] = None
+    description: Optional[str] = 'No description available'
+    stock: int = 0
+    vat_code: str = 's'
+    rrp: float = 0
+    discount: float = 0
+    weight: float = 0
+    language: Optional[str] = 'en'
+    # Derived, not a column: the four-digit year, parsed once as the row is streamed in
+    pub_year: Optional[str] = field(init=False, default=None)
+
+    def __post_init__(self):
+        # The inventory columns are TEXT; a stock that is not a whole number raises here
+        self.stock = int(self.stock)
+        self.pub_year = extract_year(self.publication_year) if self.publication_year is not None else None
+
+    @classmethod
+    def from_row(cls, row: dict) -> 'Listing':
+        return cls(**{name: row[name] for name in _LISTING_FIELDS if name in row})
+
+
+_LISTING_FIELDS = tuple(f.name for f in fields(Listing) if f.init)
+# PostgREST select list: fetch just the columns Listing uses rather than '*'. Values are
+# converted in Python, so one bad value skips its row instead of failing the whole page
+LISTING_COLUMNS = ','.join(_LISTING_FIELDS)
+
+
+def listings_from_rows(rows):
+    """Yield a Listing per row, skipping rows whose values do not convert (e.g. a blank stock)"""
+    for row in rows:
+        try:
+            yield Listing.from_row(row)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Skipping item {row.get('id')}: {e}")
+
+
+@functools.lru_cache(maxsize=4096)
+def generate_book_title(
+    book_name: str = '',
+    author: str = '',
+    binding_type: str = None,
+    publication_year: str = None,
+    max_len: int = 65
+) -> str:
+    """
+    Construct a concise title from available info. Missing fields are skipped gracefully.
+    Bindings are shortened with BINDING_WITH_DEFAULTS. The result depends only on the
+    arguments, so repeated stock (same title, author, binding, year) is a cache hit.
+    """
+    code_map = BINDING_WITH_DEFAULTS
+
+    parts: List[str] = []
+    # Add book name
+    if book_name:
+        parts.append(book_name)
+    # Add author
+    if author:
+        parts.extend(['by', author])
+    # Add binding type
+    if binding_type:
+        parts.extend([binding_type, 'Book'])
+    # Add publication year
+    if publication_year:
+        parts.append(str(publication_year))
+
+    # Join and normalize whitespace; split() drops every run of whitespace in one pass
+    title = ' '.join(' '.join(parts).split())
+
+    # If within limits, return early
+    if len(title) <= max_len:
+        return title
+
+    # Remove publication year if too long
+    if publication_year and title.endswith(str(publication_year)):
+        title = title[:-(len(str(publication_year))+1)].strip()
+        if len(title) <= max_len:
+            return title
+
+    # Replace binding_type with shortcode
+    if binding_type and binding_type in code_map:
+        title = title.replace(f' {binding_type} ', f' {code_map[binding_type]} ').strip()
+        if len(title) <= max_len:
+            return title
+
+    # Remove 'by' to shorten
+    title_no_by = title.replace(' by ', ' ').strip()
+    if len(title_no_by) <= max_len:
+        return title_no_by
+
+    # Abbreviate author
+    if author:
+        names = author.split()
+        if len(names) > 1:
+            abbr_author = names[0][0] + '. ' + ' '.join(names[1:])
+        else:
+            abbr_author = names[0][0] + '.'
+        title = title.replace(author, abbr_author).strip()
+        if len(title) <= max_len:
+            return title
+
+    # Fallback to hard truncate
+    return title[:max_len-3].rstrip() + '...'
+
+
+def extract_year(date_str):
+    text = date_str if isinstance(date_str, str) else str(date_str)
+    # Fast path for the usual 'YYYY' / 'YYYY-MM-DD' values: a leading four-digit word
+    if len(text) >= 4 and text[:4].isdecimal() and not (text[4:5].isalnum() or text[4:5] == '_'):
+        return text[:4]
+    match = _YEAR_RE.search(text)
+    return match.group(0) if match else None
+
+
+def calculate_start_price(item: Listing):
+    try:
+        return cached_start_price(item.rrp, item.discount, item.weight, item.vat_code)
+    except Exception as e:
+        logger.exception(f"Price calc error for {item.id}: {e}")
+        return None
+
+
+def xml_escape(text):
+    # Uncached, for long one-off values such as descriptions
+    return text.translate(_XML_ESCAPE_TABLE)
+
+
+@functools.lru_cache(maxsize=4096)
+def xml_safe(text):
+    # Publishers, bindings and languages repeat across the catalogue, so most calls are cache hits
+    return text.translate(_XML_ESCAPE_TABLE)
+
+
+def sanitize_description(raw_description):
+    # Most descriptions carry no links at all; substring checks are far cheaper than the regexes
+    lowered = raw_description.lower()
+    if '<a' not in lowered and 'http' not in lowered and 'www.' not in lowered:
+        return raw_description
+
+    # Remove HTML <a> tags completely
+    no_html_links = _HTML_A_RE.sub(r'\1 [LINK]', raw_description)
+    
+    # Replace plain URLs (http, https, www) with [LINK]
+    no_plain_links = _URL_RE.sub('[LINK]', no_html_links)
+    
+    return no_plain_links
+
+
+def stock_visiblity(actual_stock):
+    # Show 2 below 10 in stock, cap at 10 above 50, otherwise the real count
+    if actual_stock >= 10:
+        return 10 if actual_stock > 50 else actual_stock
+    return 2
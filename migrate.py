@@ -0,0 +1,95 @@
+import os
+import logging
+from typing import List
+from supabase import create_client, Client
+from calculate_price import start_price_sql
+
+# One-off schema setup for the listing scripts; run it once per table (or from CI)
+# instead of checking the columns at the start of every listing run
+logging.basicConfig(level=logging.INFO)
+
+table_name = os.getenv('SUPABASE_TABLE_NAME')
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+# Dropping and re-adding final_price rewrites the whole table and breaks anything that
+# depends on the column, so an existing one is only rebuilt when asked for explicitly
+REBUILD_FINAL_PRICE = os.getenv('REBUILD_FINAL_PRICE') == '1'
+
+
+def get_existing_columns(supabase: Client, table_name: str) -> List[str]:
+    """Retrieve current table columns from Supabase using a row sample"""
+    try:
+        result = supabase.table(table_name).select("*").limit(1).execute()
+        if result.data and len(result.data) > 0:
+            return list(result.data[0].keys())
+        elif result.data == []:
+            # No rows, but table exists: get from 'columns' attribute
+            # Some Supabase clients return column metadata in response
+            return result.model_dump().get("columns", [])
+        return []
+    except Exception as e:
+        logging.error(f"❌ Column detection error: {e}")
+        return []
+
+
+def add_column(supabase: Client, column: str, definition: str, replace: bool = False) -> bool:
+    """
+    ALTER TABLE ... ADD COLUMN IF NOT EXISTS through the execute_sql RPC; returns True on
+    success. With replace, an existing column is dropped and re-added in the same statement
+    """
+    if replace:
+        logging.info(f"🔁 Redefining '{column}' column...")
+        sql = f"""
+    ALTER TABLE {table_name}
+    DROP COLUMN IF EXISTS {column},
+    ADD COLUMN {column} {definition};
+    """
+    else:
+        logging.info(f"➕ '{column}' column missing — adding it...")
+        sql = f"""
+    ALTER TABLE {table_name}
+    ADD COLUMN IF NOT EXISTS {column} {definition};
+    """
+    try:
+        res = supabase.rpc('execute_sql', {'sql': sql}).execute()
+
+        code = getattr(res, 'status_code', None)
+        if code is not None and code >= 400:
+            logging.error(f"❌ Failed to add '{column}' column ({code}): {res.data}")
+            return False
+    except Exception as e:
+        # catch network/validation errors
+        logging.error(f"❌ RPC call failed: {e}")
+        return False
+    logging.info(f"✅ '{column}' column is ensured.")
+    return True
+
+
+def main():
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    columns = get_existing_columns(supabase, table_name)
+    logging.info(f"🧾 Columns in {table_name}: {columns}")
+
+    ok = True
+    if "listed" not in columns:
+        ok &= add_column(supabase, "listed", "boolean DEFAULT FALSE NOT NULL")
+    # Start price as a stored generated column, so unlistable rows are filtered in SQL. Set
+    # REBUILD_FINAL_PRICE=1 after changing the pricing constants (or to pick up the casts that
+    # tolerate non-numeric rrp/discount/weight values) to replace an existing column
+    final_price_definition = f"numeric GENERATED ALWAYS AS ({start_price_sql()}) STORED"
+    if "final_price" not in columns:
+        ok &= add_column(supabase, "final_price", final_price_definition)
+    elif REBUILD_FINAL_PRICE:
+        ok &= add_column(supabase, "final_price", final_price_definition, replace=True)
+    else:
+        logging.info("'final_price' column exists; set REBUILD_FINAL_PRICE=1 to redefine it.")
+
+    if ok:
+        logging.info(f"Schema for {table_name} is up to date.")
+    else:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
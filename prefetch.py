@@ -0,0 +1,36 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, maxsize: int = 32):
+    """
+    Iterate `iterable` on a background thread with up to `maxsize` items buffered, so a
+    slow producer (paged Supabase reads) keeps running while the consumer works
+    """
+    buffer = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(_Failure(e))
+        else:
+            buffer.put(_DONE)
+
+    # Daemon, so a consumer that stops early never keeps the process alive
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
@@ -0,0 +1,32 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket: refills at `rate` tokens/sec, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = max(1.0, capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Back every caller off for `seconds`, e.g. after the server asks us to slow down"""
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+            self._updated = time.monotonic()
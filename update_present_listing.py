@@ -6,6 +6,7 @@ SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 TABLE_NAME = "listing_phase2"
 ISBN_FILE_PATH = "listed_isbns.txt"
+CHUNK_SIZE = 500
 
 # Connect to Supabase
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
@@ -15,14 +16,17 @@ print("Connected to Supabase")
 with open(ISBN_FILE_PATH, 'r') as file:
     isbn_list = [line.strip() for line in file if line.strip()]
 
-# Process each ISBN
-for isbn in isbn_list:
-    # Check if ISBN exists
-    result = supabase.table(TABLE_NAME).select("id").eq("isbn13", isbn).execute()
-    
-    if result.data:
-        # Update 'listed' column to TRUE
-        update_res = supabase.table(TABLE_NAME).update({"listed": True}).eq("isbn13", isbn).execute()
-        print(f"Updated: {isbn}")
-    else:
-        print(f"Not found: {isbn}")
+# Flag ISBNs in chunks with one UPDATE each; rows that do not exist are simply not
+# updated, and the returned rows tell us which ISBNs matched. Chunks keep the
+# in.(...) filter within URL-length limits
+for start in range(0, len(isbn_list), CHUNK_SIZE):
+    chunk = isbn_list[start:start + CHUNK_SIZE]
+    # Update 'listed' column to TRUE
+    result = supabase.table(TABLE_NAME).update({"listed": True}).in_("isbn13", chunk).execute()
+    found = {row["isbn13"] for row in result.data}
+
+    for isbn in chunk:
+        if isbn in found:
+            print(f"Updated: {isbn}")
+        else:
+            print(f"Not found: {isbn}")
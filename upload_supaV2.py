@@ -1,8 +1,15 @@
 import os
 import csv
-import json
+import orjson
+import asyncio
+import gzip
+import hashlib
 import logging
-from typing import List, Dict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+import httpx
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
 from supabase import create_client, Client
@@ -17,6 +24,15 @@ SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 TABLE_NAME = os.getenv('SUPABASE_TABLE_NAME')
 BATCH_SIZE = 5000
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+SCHEMA_CACHE_PATH = Path('.schema_cache.json')
+# undefined_table / undefined_column, and PostgREST's table/column-not-found codes
+SCHEMA_ERROR_CODES = {'42P01', '42703', 'PGRST204', 'PGRST205'}
+MAX_CONCURRENT_BATCHES = 8
+# Gzip request bodies; only turn on when the endpoint in front of PostgREST accepts Content-Encoding
+GZIP_UPLOADS = os.getenv('SUPABASE_GZIP_UPLOADS') == '1'
+# Maps every ASCII character other than a letter, digit or '_' to '_' in one C-level pass
+_COLUMN_NAME_TABLE = str.maketrans({chr(i): '_' for i in range(128) if not (chr(i).isalnum() or chr(i) == '_')})
 
 
 def get_existing_columns(supabase: Client) -> List[str]:
@@ -31,8 +47,9 @@ def get_existing_columns(supabase: Client) -> List[str]:
         return []
 
 
-def check_and_create_table(supabase: Client, data_columns: List[str]):
-    """Ensure table schema matches CSV structure and set ean as primary key"""
+def _apply_schema(supabase: Client, data_columns: List[str]) -> bool:
+    """Ensure table schema matches CSV structure and set ean as primary key; returns True if it all succeeded"""
+    ok = True
     try:
         # Check if table exists
         supabase.table(TABLE_NAME).select("*").limit(1).execute()
@@ -43,10 +60,11 @@ def check_and_create_table(supabase: Client, data_columns: List[str]):
         missing = [col for col in data_columns if col not in existing_columns]
         if missing:
             logging.info(f"Adding missing columns: {missing}")
-            for col in missing:
-                supabase.rpc('execute_sql', {
-                    'sql': f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS {col} TEXT;"
-                }).execute()
+            # One ALTER for all of them rather than one RPC per column
+            adds = ", ".join(f"ADD COLUMN IF NOT EXISTS {col} TEXT" for col in missing)
+            supabase.rpc('execute_sql', {
+                'sql': f"ALTER TABLE {TABLE_NAME} {adds};"
+            }).execute()
             time.sleep(2)
 
         # Ensure primary key on ean
@@ -60,6 +78,7 @@ def check_and_create_table(supabase: Client, data_columns: List[str]):
                 pass
             else:
                 logging.error(f"Error adding primary key: {e}")
+                ok = False
         time.sleep(2)
 
     except Exception as e:
@@ -73,12 +92,130 @@ def check_and_create_table(supabase: Client, data_columns: List[str]):
             time.sleep(5)
         else:
             raise
+    return ok
+
+
+def _schema_cache_key() -> str:
+    """Cache entries are per project and table, so another SUPABASE_URL never reuses them"""
+    return f"{SUPABASE_URL}|{TABLE_NAME}"
+
+
+def _load_schema_cache() -> Dict[str, str]:
+    try:
+        return orjson.loads(SCHEMA_CACHE_PATH.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def check_and_create_table(supabase: Client, data_columns: List[str]):
+    """Ensure table schema matches CSV structure, skipping the round-trips when an earlier upload already applied this column set"""
+    key = hashlib.sha256(",".join(sorted(data_columns)).encode()).hexdigest()
+    cache = _load_schema_cache()
+    if cache.get(_schema_cache_key()) == key:
+        logging.info(f"Schema for {TABLE_NAME} unchanged since last upload, skipping checks")
+        return
+
+    # Only a fully applied schema is remembered; otherwise the next upload tries again
+    if _apply_schema(supabase, data_columns):
+        cache[_schema_cache_key()] = key
+        SCHEMA_CACHE_PATH.write_bytes(orjson.dumps(cache))
+
+
+def invalidate_schema_cache() -> None:
+    """Forget this table's cached schema, e.g. after the table was dropped or recreated"""
+    cache = _load_schema_cache()
+    if cache.pop(_schema_cache_key(), None) is not None:
+        SCHEMA_CACHE_PATH.write_bytes(orjson.dumps(cache))
+        logging.warning(f"Cleared cached schema for {TABLE_NAME}; the next upload re-checks it")
+
+
+def _is_schema_error(exc: BaseException) -> bool:
+    """True for PostgREST/Postgres errors about a missing table or column"""
+    if not isinstance(exc, httpx.HTTPStatusError):
+        return False
+    try:
+        code = exc.response.json().get('code')
+    except ValueError:
+        return False
+    return code in SCHEMA_ERROR_CODES
 
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def safe_batch_insert(supabase: Client, batch: List[Dict]) -> None:
+async def safe_batch_insert(client: httpx.AsyncClient, batch: List[Dict]) -> None:
     """Retryable batch insert operation using upsert to ignore duplicates on ean"""
-    supabase.table(TABLE_NAME).upsert(batch, on_conflict="ean", ignore_duplicates=True).execute()
+    body = orjson.dumps(batch)
+    headers = None
+    if GZIP_UPLOADS:
+        # zlib releases the GIL, so compressing off the loop overlaps with other batches
+        body = await asyncio.to_thread(gzip.compress, body, 6)
+        headers = {"Content-Encoding": "gzip"}
+    response = await client.post(f"/rest/v1/{TABLE_NAME}", params={"on_conflict": "ean"}, content=body, headers=headers)
+    response.raise_for_status()
+
+
+def _skip_invalid_row(row) -> str:
+    logging.warning(f"Skipping malformed CSV row {row.number}: expected {row.expected_columns} "
+                    f"columns, got {row.actual_columns}")
+    return 'skip'
+
+
+def read_batches(csv_path: str, header: List[str]) -> Iterator[List[Dict]]:
+    """Yield the CSV's rows as dicts, at most BATCH_SIZE at a time"""
+    # pyarrow parses the file in native code one block at a time, keeping every value
+    # a string, so memory stays flat however big the CSV is; only the slice being
+    # handed out is turned into Python dicts. open_csv is always single-threaded: bounded
+    # memory is chosen over read_csv's multi-threaded parse, which needs the whole file
+    # in memory; even serial, the native parse is rarely the bottleneck next to the uploads
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(skip_rows=1, column_names=header, block_size=CSV_BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=_skip_invalid_row),
+        convert_options=pacsv.ConvertOptions(column_types={h: pa.string() for h in header})
+    )
+    for record_batch in reader:
+        for start in range(0, record_batch.num_rows, BATCH_SIZE):
+            yield record_batch.slice(start, BATCH_SIZE).to_pylist()
+
+
+async def insert_batches(batches: Iterable[List[Dict]]) -> Tuple[int, List[List[Dict]]]:
+    """Insert batches concurrently over one REST client; returns (inserted, failed_batches)"""
+    inserted = 0
+    failed_batches = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=ignore-duplicates,return=minimal"
+    }
+
+    async with httpx.AsyncClient(base_url=SUPABASE_URL, headers=headers, timeout=60) as client:
+
+        async def insert_batch(batch_num: int, batch: List[Dict]) -> None:
+            nonlocal inserted
+            try:
+                await safe_batch_insert(client, batch)
+                inserted += len(batch)
+                logging.info(f"Batch {batch_num} inserted ({inserted} rows so far)")
+            except RetryError as e:
+                logging.error(f"Batch {batch_num} failed after retries: {e.last_attempt.exception()}")
+                failed_batches.append(batch)
+                if _is_schema_error(e.last_attempt.exception()):
+                    invalidate_schema_cache()
+            except Exception as e:
+                logging.error(f"Unexpected error in batch {batch_num}: {e}")
+                failed_batches.append(batch)
+            finally:
+                semaphore.release()
+
+        tasks = []
+        for batch_num, batch in enumerate(batches, 1):
+            # Only pull the next batch off the file once a slot is free
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(insert_batch(batch_num, batch)))
+        await asyncio.gather(*tasks)
+
+    return inserted, failed_batches
 
 
 def upload_csv_to_supabase(csv_path: str) -> None:
@@ -87,39 +224,23 @@ def upload_csv_to_supabase(csv_path: str) -> None:
     logging.info("Connected to Supabase")
 
     # Read CSV file with UTF-8 encoding
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        data_columns = [normalize_column_name(col) for col in reader.fieldnames]
-        rows = [row for row in reader]
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f))
+    data_columns = [normalize_column_name(col) for col in header]
 
     check_and_create_table(supabase, data_columns)
-    
-    total_records = len(rows)
-    inserted = 0
-    failed_batches = []
 
-    for batch_idx in range(0, total_records, BATCH_SIZE):
-        batch = rows[batch_idx:batch_idx + BATCH_SIZE]
-        batch_num = (batch_idx // BATCH_SIZE) + 1
+    # Batches go out concurrently; a 429 from the server is backed off by the retry
+    inserted, failed_batches = asyncio.run(insert_batches(read_batches(csv_path, header)))
 
-        try:
-            safe_batch_insert(supabase, batch)
-            inserted += len(batch)
-            logging.info(f"Batch {batch_num} inserted ({inserted}/{total_records})")
-            time.sleep(1)
-        except RetryError as e:
-            logging.error(f"Batch {batch_num} failed after retries: {e.last_attempt.exception()}")
-            failed_batches.append(batch)
-        except Exception as e:
-            logging.error(f"Unexpected error in batch {batch_num}: {e}")
-            failed_batches.append(batch)
+    total_records = inserted + sum(len(batch) for batch in failed_batches)
 
     # Handle failed batches
     if failed_batches:
         timestamp = int(time.time())
         failed_file = f"failed_batches_{timestamp}.json"
-        with open(failed_file, 'w') as f:
-            json.dump(failed_batches, f)
+        with open(failed_file, 'wb') as f:
+            f.write(orjson.dumps(failed_batches, option=orjson.OPT_APPEND_NEWLINE))
         logging.error(f"Saved {len(failed_batches)} failed batches to {failed_file}")
 
     logging.info(f"Upload complete. Success: {inserted}/{total_records}")
@@ -128,5 +249,8 @@ def upload_csv_to_supabase(csv_path: str) -> None:
 def normalize_column_name(name: str) -> str:
     """Convert column name to lowercase and sanitize"""
     name = name.strip().lower().replace(' ', '_')
-    name = ''.join([c if c.isalnum() or c == '_' else '_' for c in name])
+    if name.isascii():
+        name = name.translate(_COLUMN_NAME_TABLE)
+    else:
+        name = ''.join([c if c.isalnum() or c == '_' else '_' for c in name])
     return name[:63] if name else 'unknown_column'